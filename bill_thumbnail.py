@@ -1,17 +1,28 @@
 import argparse
+import hashlib
+import json
 import logging
+import math
+import os
+import resource
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import get_context
 from pathlib import Path
 
 import boto3
-import requests
-import time
 from tqdm import tqdm
 from wand.image import Image as wandImage
 
 from politylink.graphql.client import GraphQLClient
+from snapshot import GraphQLSnapshot
+from utils import HttpClient, HostRateLimiter
 
 LOGGER = logging.getLogger(__name__)
+PDF_DPI = 72  # PDF page size is given in points (1/72 inch)
+THUMBNAIL_WIDTH = 640
+THUMBNAIL_HEIGHT = 320
 
 """
 requires ~/.aws/credentials
@@ -19,17 +30,64 @@ https://boto3.amazonaws.com/v1/documentation/api/latest/guide/quickstart.html
 """
 
 
-def save_thumbnail(pdf_path, thumbnail_path):
+def calc_resolution(pdf_path):
+    """
+    calculate the lowest DPI to rasterize the first page at least THUMBNAIL_WIDTH pixels wide
+    """
+
+    with wandImage.ping(filename=f'{pdf_path}[0]', resolution=PDF_DPI, format='pdf') as image:
+        page_width = image.width
+    return math.ceil(PDF_DPI * THUMBNAIL_WIDTH / page_width)
+
+
+def save_thumbnail(pdf_path, thumbnail_path, resolution=None):
     """
     https://qiita.com/tomtsutom0122/items/bb5acaee4f4f7820124c
+    :param resolution: DPI to rasterize PDF. calculated from the page size if None
+    """
+
+    if resolution is None:
+        resolution = calc_resolution(pdf_path)
+    with wandImage(filename=f'{pdf_path}[0]', resolution=resolution, format='pdf') as image:
+        image.transform(resize=str(THUMBNAIL_WIDTH))
+        image.crop(width=THUMBNAIL_WIDTH, height=THUMBNAIL_HEIGHT)
+        image.alpha_channel = 'remove'
+        image.save(filename=thumbnail_path)
+
+
+def measure_thumbnail(pdf_path, thumbnail_path, resolution):
+    """
+    run save_thumbnail in a fresh process and return elapsed time (sec) and peak RSS (MB)
+    peak RSS includes Ghostscript, which ImageMagick calls as a child process to rasterize PDF
     """
 
-    image = wandImage(filename=f'{pdf_path}[0]', resolution=300, format="pdf")
-    image.transform(resize='640')
-    image.crop(width=640, height=320)
-    image.alpha_channel = 'remove'
-    image.save(filename=thumbnail_path)
-    return image.make_blob()
+    start_time = time.perf_counter()
+    save_thumbnail(pdf_path, thumbnail_path, resolution)
+    elapsed = time.perf_counter() - start_time
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return elapsed, max_rss / 1024  # ru_maxrss is in KB on Linux
+
+
+def benchmark(pdf_paths):
+    """
+    compare the fixed 300 DPI rasterization with the DPI calculated from the page size
+    """
+
+    mode2resolution = {'300dpi': 300, 'auto': None}
+    mode2results = defaultdict(list)
+    for pdf_path in pdf_paths:
+        for mode, resolution in mode2resolution.items():
+            thumbnail_path = str(Path(pdf_path).with_suffix(f'.{mode}.png'))
+            # spawn a new process per measurement so that peak RSS is not carried over
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                elapsed, max_rss = executor.submit(measure_thumbnail, pdf_path, thumbnail_path, resolution).result()
+            mode2results[mode].append((elapsed, max_rss))
+            LOGGER.info(f'{pdf_path} ({mode}): {elapsed:.2f}s, {max_rss:.1f}MB')
+    for mode, results in mode2results.items():
+        LOGGER.info('{}: {:.2f}s average time, {:.1f}MB average peak RSS'.format(
+            mode, sum(r[0] for r in results) / len(results), sum(r[1] for r in results) / len(results)
+        ))
 
 
 def get_maybe_summary_pdf(bill):
@@ -42,72 +100,222 @@ def get_maybe_summary_pdf(bill):
     return None
 
 
+class Manifest:
+    """
+    JSON file to record the status of each bill, so that an interrupted run can resume
+    """
+
+    DONE = 'done'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, json_fp, save_interval=20):
+        self.json_fp = json_fp
+        self.save_interval = save_interval
+        self.num_unsaved = 0
+        if os.path.exists(json_fp):
+            with open(json_fp, 'r') as f:
+                self.data = json.load(f)
+        else:
+            self.data = dict()
+
+    def is_done(self, bill_id):
+        return bill_id in self.data and self.data[bill_id]['status'] == self.DONE
+
+    def is_published(self, bill_id):
+        return self.is_done(bill_id) and self.data[bill_id].get('published', False)
+
+    def get_validators(self, bill_id, url, publish):
+        """
+        return ETag, Last-Modified and content hash of the summary PDF used for the current thumbnail
+        empty if the thumbnail needs to be generated anyway, i.e. the local file or the S3 upload is missing
+        """
+
+        if not self.is_done(bill_id) or self.data[bill_id].get('url') != url:
+            return dict()
+        local_path, _, _ = get_paths(bill_id)
+        if not local_path.exists() or (publish and not self.is_published(bill_id)):
+            return dict()
+        return {key: self.data[bill_id][key] for key in ['etag', 'last_modified', 'pdf_hash']
+                if self.data[bill_id].get(key)}
+
+    def set(self, bill_id, status, **kwargs):
+        self.data[bill_id] = dict(status=status, updated_at=time.time(), **kwargs)
+        self.num_unsaved += 1
+        if self.num_unsaved >= self.save_interval:
+            self.save()
+
+    def save(self):
+        Path(self.json_fp).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.json_fp, 'w') as f:
+            json.dump(self.data, f)
+        self.num_unsaved = 0
+
+
+def get_paths(bill_id):
+    id_body = bill_id.split(':')[-1]
+    local_path = Path(f'./image/bill/{id_body}.png')
+    s3_path = Path(f'bill/{id_body}.png')
+    pdf_path = local_path.with_suffix('.pdf')
+    return local_path, s3_path, pdf_path
+
+
+def download_pdf(http_client, host_limiter, summary_pdf, pdf_path, validators):
+    """
+    download summary PDF with a conditional GET using validators of the previous download
+    :return: tuple of (whether PDF has changed, new validators)
+    """
+
+    headers = dict()
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'last_modified' in validators:
+        headers['If-Modified-Since'] = validators['last_modified']
+    response = http_client.get(summary_pdf, headers=headers, limiter=host_limiter.get(summary_pdf))
+    if response.status_code == 304:
+        LOGGER.debug(f'{summary_pdf} is not modified')
+        return False, validators
+    if not response.ok:
+        raise ValueError(f'failed to fetch {summary_pdf}: status={response.status_code}')
+
+    new_validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'pdf_hash': hashlib.sha256(response.content).hexdigest()
+    }
+    new_validators = {key: value for key, value in new_validators.items() if value}
+    if new_validators['pdf_hash'] == validators.get('pdf_hash'):
+        LOGGER.debug(f'{summary_pdf} has the same content')
+        return False, new_validators
+    with open(pdf_path, 'wb') as f:
+        f.write(response.content)
+    LOGGER.debug(f'saved {pdf_path}')
+    return True, new_validators
+
+
+def upload_thumbnail(s3_client, local_path, s3_path):
+    s3_client.upload_file(str(local_path), 'politylink', str(s3_path), ExtraArgs={'ContentType': 'image/png'})
+    LOGGER.debug(f'published {s3_path}')
+
+
 def main():
     gql_client = GraphQLClient(url="https://graphql.politylink.jp/")
     s3_client = boto3.client('s3')
+    http_client = HttpClient(pool_size=args.workers)
+    host_limiter = HostRateLimiter(args.interval)
 
-    bills = gql_client.get_all_bills(fields=['id', 'urls'])
+    snapshot = GraphQLSnapshot(gql_client, run_id=args.run_id)
+    bills = snapshot.get_all_bills(fields=['id', 'urls'])
     LOGGER.info(f'fetched {len(bills)} bills')
+    manifest = Manifest(args.manifest)
+    LOGGER.info(f'loaded {len(manifest.data)} records from {args.manifest}')
 
     stats = defaultdict(int)
-    for bill in tqdm(bills):
+    id2pdf = dict()
+    id2validators = dict()
+    for bill in bills:
         LOGGER.debug(f'check {bill.id}')
         if bill.id in ['Bill:bbPoZw2urVnHTTlaaQoJ0w', 'Bill:f8x2G9CNRnIQptRJFCNZ2A']:
             continue
 
-        id_body = bill.id.split(':')[-1]
-        local_path = Path(f'./image/bill/{id_body}.png')
-        s3_path = Path(f'bill/{id_body}.png')
-        pdf_path = local_path.with_suffix('.pdf')
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-
-        if local_path.exists() and not args.overwrite:
-            LOGGER.debug(f'{local_path} already exists')
-            continue
+        local_path, _, _ = get_paths(bill.id)
+        if not args.overwrite:
+            if manifest.is_done(bill.id):
+                LOGGER.debug(f'{bill.id} is already done')
+                continue
+            if bill.id not in manifest.data and local_path.exists():
+                LOGGER.debug(f'{local_path} already exists')
+                continue
 
         maybe_summary_pdf = get_maybe_summary_pdf(bill)
         if not maybe_summary_pdf:
             LOGGER.debug('summary PDF does not exist')
+            manifest.set(bill.id, Manifest.SKIPPED)
+            stats['skip'] += 1
             continue
-        summary_pdf = maybe_summary_pdf
-
-        stats['process'] += 1
-        time.sleep(1)
-
-        response = requests.get(summary_pdf)
-        if not response.ok:
-            LOGGER.warning(f'failed to fetch {summary_pdf}')
-            stats['fail'] += 1
-            continue
-        with open(pdf_path, 'wb') as f:
-            f.write(response.content)
-        LOGGER.debug(f'saved {pdf_path}')
+        id2pdf[bill.id] = maybe_summary_pdf
+        id2validators[bill.id] = dict() if args.force else \
+            manifest.get_validators(bill.id, maybe_summary_pdf, args.publish)
+    LOGGER.info(f'found {len(id2pdf)} bills to process')
+    Path('./image/bill').mkdir(parents=True, exist_ok=True)
 
+    # each bill goes through download -> rasterize -> upload, and each stage has its own executor
+    # raster workers are spawned since they start while download threads are running, which makes fork unsafe
+    future2task = dict()
+    with ThreadPoolExecutor(max_workers=args.workers) as download_executor, \
+            ProcessPoolExecutor(max_workers=args.raster_workers, mp_context=get_context('spawn')) as raster_executor, \
+            ThreadPoolExecutor(max_workers=args.workers) as upload_executor, \
+            tqdm(total=len(id2pdf)) as pbar:
         try:
-            save_thumbnail(pdf_path, local_path)
-        except Exception:
-            LOGGER.exception(f'failed to save {summary_pdf}')
-            stats['fail'] += 1
-            continue
-        LOGGER.debug(f'saved {local_path}')
+            for bill_id, summary_pdf in id2pdf.items():
+                _, _, pdf_path = get_paths(bill_id)
+                future = download_executor.submit(download_pdf, http_client, host_limiter, summary_pdf, pdf_path,
+                                                  id2validators[bill_id])
+                future2task[future] = (bill_id, 'download')
+                stats['process'] += 1
+
+            while future2task:
+                done, _ = wait(future2task, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bill_id, stage = future2task.pop(future)
+                    summary_pdf = id2pdf[bill_id]
+                    local_path, s3_path, pdf_path = get_paths(bill_id)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        LOGGER.exception(f'failed to {stage} {summary_pdf}')
+                        manifest.set(bill_id, Manifest.FAILED, stage=stage, url=summary_pdf)
+                        stats['fail'] += 1
+                        pbar.update()
+                        continue
 
-        if args.publish:
-            s3_client.upload_file(str(local_path), 'politylink', str(s3_path), ExtraArgs={'ContentType': 'image/png'})
-            LOGGER.debug(f'published {s3_path}')
+                    if stage == 'download':
+                        is_changed, id2validators[bill_id] = result
+                        if not is_changed:
+                            manifest.set(bill_id, Manifest.DONE, url=summary_pdf,
+                                         published=manifest.is_published(bill_id), **id2validators[bill_id])
+                            stats['unchanged'] += 1
+                            pbar.update()
+                            continue
+                        next_future = raster_executor.submit(save_thumbnail, pdf_path, local_path, args.dpi)
+                        future2task[next_future] = (bill_id, 'rasterize')
+                    elif stage == 'rasterize' and args.publish:
+                        LOGGER.debug(f'saved {local_path}')
+                        next_future = upload_executor.submit(upload_thumbnail, s3_client, local_path, s3_path)
+                        future2task[next_future] = (bill_id, 'upload')
+                    else:
+                        manifest.set(bill_id, Manifest.DONE, url=summary_pdf, published=args.publish,
+                                     **id2validators[bill_id])
+                        pbar.update()
+        finally:
+            manifest.save()
 
-    LOGGER.info('processed {} bills ({} success, {} fail)'.format(
-        stats['process'], stats['process'] - stats['fail'], stats['fail']
+    LOGGER.info('processed {} bills ({} success, {} fail, {} skip, {} unchanged)'.format(
+        stats['process'], stats['process'] - stats['fail'], stats['fail'], stats['skip'], stats['unchanged']
     ))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='法律案のサムネイルを概要PDFから生成する')
     parser.add_argument('-p', '--publish', help='画像をS3にアップロードする', action='store_true')
-    parser.add_argument('-o', '--overwrite', help='画像を再生成する', action='store_true')
+    parser.add_argument('-o', '--overwrite', help='概要PDFが更新されたBillの画像を再生成する', action='store_true')
+    parser.add_argument('-f', '--force', help='概要PDFが更新されていなくても画像を再生成する（--overwriteと併用）',
+                        action='store_true')
+    parser.add_argument('-m', '--manifest', help='各Billの処理状況を記録するjsonファイル',
+                        default='./image/bill/manifest.json')
+    parser.add_argument('-w', '--workers', help='PDFのダウンロードとS3へのアップロードのスレッド数', type=int, default=4)
+    parser.add_argument('--raster_workers', help='PDFを画像に変換するプロセス数', type=int, default=os.cpu_count())
+    parser.add_argument('--interval', help='同じホストへのリクエストの最小間隔（秒）', type=float, default=1)
+    parser.add_argument('--run_id', help='同じIDで保存されたGraphQLのスナップショットを再利用する（cron.pyが指定する）')
+    parser.add_argument('--dpi', help='PDFを画像に変換する解像度（指定しない場合はページサイズから計算する）', type=int)
+    parser.add_argument('--benchmark', help='指定したPDFで解像度300と自動計算の変換時間とメモリ使用量を比較する', nargs='+')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     logging.getLogger('sgqlc').setLevel(logging.INFO)
     logging.getLogger('botocore').setLevel(logging.WARNING)
-    main()
+    if args.benchmark:
+        benchmark(args.benchmark)
+    else:
+        main()
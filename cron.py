@@ -1,6 +1,7 @@
 import argparse
 import logging
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from enum import Enum
 from pathlib import Path
@@ -23,12 +24,17 @@ DATE_FORMAT = '%Y-%m-%d'
 LOG_DATE_FORMAT = "%Y-%m-%d %I:%M:%S"
 LOG_FORMAT = '%(asctime)s [%(name)s] %(levelname)s: %(message)s'
 
+# scripts in the same run share GraphQL snapshots saved with this id
+RUN_ID = datetime.now().strftime('%Y%m%d%H%M%S')
+
 
 class BashTask:
-    def __init__(self, cmd, cwd=None, log_fp=None):
+    def __init__(self, cmd, cwd=None, log_fp=None, name=None, deps=None):
         self.cmd = cmd
         self.cwd = cwd if cwd else '.'
         self.log_fp = str(log_fp) if log_fp else '/dev/null'
+        self.name = name if name else cmd
+        self.deps = deps if deps else []
 
     def __repr__(self):
         return f'<BashTask {self.cmd}>'
@@ -42,61 +48,77 @@ class BashTask:
 
 
 DAILY_LOG_ROOT = LOG_ROOT / 'daily'
+# minutes spiders link minutes to bills and committees, so they need to be crawled first
+MINUTES_CRAWL_DEPS = ['crawl_shugiin', 'crawl_sangiin', 'crawl_shugiin_committee', 'crawl_sangiin_committee']
 DAILY_TASKS = [
     BashTask('poetry run scrapy crawl shugiin',
-             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_shugiin.log'),
+             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_shugiin.log', name='crawl_shugiin'),
     BashTask('poetry run scrapy crawl sangiin',
-             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_sangiin.log'),
+             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_sangiin.log', name='crawl_sangiin'),
     BashTask('poetry run scrapy crawl shugiin_committee',
-             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_shugiin_committee.log'),
+             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_shugiin_committee.log', name='crawl_shugiin_committee'),
     BashTask('poetry run scrapy crawl sangiin_committee',
-             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_sangiin_committee.log'),
+             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_sangiin_committee.log', name='crawl_sangiin_committee'),
     BashTask('poetry run scrapy crawl shugiin_minutes',
-             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_shugiin_minutes.log'),
+             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_shugiin_minutes.log', name='crawl_shugiin_minutes',
+             deps=MINUTES_CRAWL_DEPS),
     BashTask('poetry run scrapy crawl sangiin_minutes',
-             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_sangiin_minutes.log'),
+             CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_sangiin_minutes.log', name='crawl_sangiin_minutes',
+             deps=MINUTES_CRAWL_DEPS),
     BashTask('poetry run scrapy crawl minutes -a start_date={} -a end_date={} -a speech=true -a text=true'.format(
         ONE_MONTH_AGO.strftime(DATE_FORMAT), TOMORROW.strftime(DATE_FORMAT)),
-        CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_minutes.log'),
-    BashTask('poetry run python minutes_wordcloud.py --start_date {} --end_date {} --publish'.format(
-        ONE_MONTH_AGO.strftime(DATE_FORMAT), TOMORROW.strftime(DATE_FORMAT)),
-        TOOLS_ROOT, DAILY_LOG_ROOT / 'minutes_wordcloud.log'),
-    BashTask('poetry run python bill_thumbnail.py --publish',
-             TOOLS_ROOT, DAILY_LOG_ROOT / 'bill_thumbnail.log'),
-    BashTask('bash crawl_bill_url.sh', CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_bill_url.log'),
-    BashTask('poetry run python news.py --start_date {} --end_date {}'.format(
+        CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_minutes.log', name='crawl_minutes',
+        deps=['crawl_shugiin_minutes', 'crawl_sangiin_minutes']),
+    BashTask('poetry run python minutes_wordcloud.py --start_date {} --end_date {} --publish --parallel'
+             ' --run_id {}'.format(
+        ONE_MONTH_AGO.strftime(DATE_FORMAT), TOMORROW.strftime(DATE_FORMAT), RUN_ID),
+        TOOLS_ROOT, DAILY_LOG_ROOT / 'minutes_wordcloud.log', name='minutes_wordcloud',
+        deps=['crawl_minutes']),
+    BashTask(f'poetry run python bill_thumbnail.py --publish --run_id {RUN_ID}',
+             TOOLS_ROOT, DAILY_LOG_ROOT / 'bill_thumbnail.log', name='bill_thumbnail',
+             deps=['crawl_shugiin', 'crawl_sangiin']),
+    BashTask('bash crawl_bill_url.sh', CRAWLER_ROOT, DAILY_LOG_ROOT / 'crawl_bill_url.log', name='crawl_bill_url',
+             deps=['crawl_shugiin', 'crawl_sangiin']),
+    # --force to re-link news already processed by hourly runs to minutes and bills crawled today
+    BashTask('poetry run python news.py --start_date {} --end_date {} --force'.format(
         SEVEN_DAYS_AGO.strftime(DATE_FORMAT), TOMORROW.strftime(DATE_FORMAT)),
-        TOOLS_ROOT, DAILY_LOG_ROOT / 'process_news.log'),
+        TOOLS_ROOT, DAILY_LOG_ROOT / 'process_news.log', name='process_news',
+        deps=['crawl_shugiin', 'crawl_sangiin', 'crawl_minutes']),
     BashTask('poetry run python timeline.py --start_date {} --end_date {}'.format(
         ONE_MONTH_AGO.strftime(DATE_FORMAT), DAY_AFTER_TOMORROW.strftime(DATE_FORMAT)),
-        TOOLS_ROOT, DAILY_LOG_ROOT / 'process_timeline.log'),
-    BashTask('poetry run python elasticsearch_syncer.py --bill --member',
-             TOOLS_ROOT, DAILY_LOG_ROOT / 'elasticsearch_syncer.log'),
+        TOOLS_ROOT, DAILY_LOG_ROOT / 'process_timeline.log', name='process_timeline',
+        deps=['process_news']),
+    BashTask(f'poetry run python elasticsearch_syncer.py --bill --member --run_id {RUN_ID}',
+             TOOLS_ROOT, DAILY_LOG_ROOT / 'elasticsearch_syncer.log', name='elasticsearch_syncer',
+             deps=['crawl_shugiin', 'crawl_sangiin', 'crawl_minutes', 'crawl_bill_url']),
 ]
 
 HOURLY_LOG_ROOT = LOG_ROOT / 'hourly'
 HOURLY_TASKS = [
     BashTask('poetry run scrapy crawl reuters -a limit=50',
-             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_reuters.log'),
+             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_reuters.log', name='crawl_reuters'),
     BashTask('poetry run scrapy crawl nikkei -a limit=50',
-             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_nikkei.log'),
+             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_nikkei.log', name='crawl_nikkei'),
     BashTask('poetry run scrapy crawl mainichi -a limit=50',
-             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_mainichi.log'),
+             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_mainichi.log', name='crawl_mainichi'),
     BashTask('poetry run scrapy crawl shugiin_tv -a start_date={} -a end_date={}'.format(
         TODAY.strftime(DATE_FORMAT), TOMORROW.strftime(DATE_FORMAT)),
-        CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_shugiin_tv.log'),
+        CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_shugiin_tv.log', name='crawl_shugiin_tv'),
     BashTask('poetry run scrapy crawl sangiin_tv',
-             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_sangiin_tv.log'),
+             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_sangiin_tv.log', name='crawl_sangiin_tv'),
     BashTask('poetry run scrapy crawl vrsdd_tv',
-             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_vrsdd_tv.log'),
+             CRAWLER_ROOT, HOURLY_LOG_ROOT / 'crawl_vrsdd_tv.log', name='crawl_vrsdd_tv'),
     BashTask('poetry run python news.py --start_date {} --end_date {}'.format(
         TODAY.strftime(DATE_FORMAT), TOMORROW.strftime(DATE_FORMAT)),
-        TOOLS_ROOT, HOURLY_LOG_ROOT / 'process_news.log'),
+        TOOLS_ROOT, HOURLY_LOG_ROOT / 'process_news.log', name='process_news',
+        deps=['crawl_reuters', 'crawl_nikkei', 'crawl_mainichi']),
     BashTask('poetry run python timeline.py --start_date {} --end_date {}'.format(
         TODAY.strftime(DATE_FORMAT), DAY_AFTER_TOMORROW.strftime(DATE_FORMAT)),
-        TOOLS_ROOT, HOURLY_LOG_ROOT / 'process_timeline.log'),
+        TOOLS_ROOT, HOURLY_LOG_ROOT / 'process_timeline.log', name='process_timeline',
+        deps=['process_news', 'crawl_shugiin_tv', 'crawl_sangiin_tv', 'crawl_vrsdd_tv']),
     BashTask('npm run build && npm run deploy',
-             GATSBY_ROOT, HOURLY_LOG_ROOT / 'gatsby.log'),
+             GATSBY_ROOT, HOURLY_LOG_ROOT / 'gatsby.log', name='gatsby',
+             deps=['process_timeline']),
 ]
 
 
@@ -114,24 +136,85 @@ class Mode(Enum):
             return HOURLY_TASKS
 
 
-def main(mode):
-    for task in mode.tasks():
-        LOGGER.info(f'{task.cmd} @ {task.cwd}')
-        try:
-            result = task.run()
-            if result.returncode != 0:
-                LOGGER.warning(result)
-                LOGGER.warning(
-                    f'received non-zero returncode={result.returncode}. check {task.log_fp} for the details.')
-        except Exception:
-            LOGGER.exception(f'failed to run {task.cmd}')
+class TaskStatus(Enum):
+    SUCCESS = 'success'
+    FAIL = 'fail'
+    SKIP = 'skip'
+
+    def __str__(self):
+        return self.value
+
+
+def run_task(task):
+    LOGGER.info(f'{task.cmd} @ {task.cwd}')
+    try:
+        result = task.run()
+        if result.returncode != 0:
+            LOGGER.warning(result)
+            LOGGER.warning(
+                f'received non-zero returncode={result.returncode}. check {task.log_fp} for the details.')
+            return TaskStatus.FAIL
+    except Exception:
+        LOGGER.exception(f'failed to run {task.cmd}')
+        return TaskStatus.FAIL
+    LOGGER.info(f'finished {task.name}')
+    return TaskStatus.SUCCESS
+
+
+def validate_tasks(tasks):
+    """
+    check that every dependency refers to a task defined earlier in the list
+    this also guarantees that the dependency graph has no cycle
+    """
+
+    names = set()
+    for task in tasks:
+        if task.name in names:
+            raise ValueError(f'duplicated task name: {task.name}')
+        for dep in task.deps:
+            if dep not in names:
+                raise ValueError(f'{task.name} depends on unknown or later task: {dep}')
+        names.add(task.name)
+
+
+def main(mode, num_workers):
+    tasks = mode.tasks()
+    validate_tasks(tasks)
+
+    name2status = dict()
+    pending = list(tasks)
+    future2task = dict()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        while pending or future2task:
+            # tasks are defined in topological order, so a single pass propagates skips through chains
+            for task in list(pending):
+                dep_statuses = [name2status.get(dep) for dep in task.deps]
+                if any(status in [TaskStatus.FAIL, TaskStatus.SKIP] for status in dep_statuses):
+                    LOGGER.warning(f'skipped {task.name} because an upstream task did not succeed')
+                    name2status[task.name] = TaskStatus.SKIP
+                    pending.remove(task)
+                elif all(status == TaskStatus.SUCCESS for status in dep_statuses):
+                    future2task[executor.submit(run_task, task)] = task
+                    pending.remove(task)
+
+            if not future2task:
+                break
+            done, _ = wait(future2task, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = future2task.pop(future)
+                name2status[task.name] = future.result()
+
+    LOGGER.info('ran {} tasks ({} success, {} fail, {} skip)'.format(
+        len(tasks), *[list(name2status.values()).count(status) for status in TaskStatus]
+    ))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='cron用のタスクを管理する')
     parser.add_argument('-m', '--mode', type=Mode, choices=list(Mode), required=True)
+    parser.add_argument('-w', '--workers', help='同時に実行するタスクの最大数', type=int, default=4)
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
                         datefmt=LOG_DATE_FORMAT, format=LOG_FORMAT)
-    main(args.mode)
+    main(args.mode, args.workers)
@@ -1,5 +1,8 @@
 import argparse
+import json
 import logging
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2
 import numpy as np
@@ -8,6 +11,7 @@ from tqdm import tqdm
 
 LOGGER = logging.getLogger(__name__)
 PIXEL_DIFF_THRESH = 10
+FFMPEG_INPUT_OPTIONS = ['-protocol_whitelist', 'file,http,https,tcp,tls,crypto']
 
 
 def get_frame(cap, sec):
@@ -17,31 +21,167 @@ def get_frame(cap, sec):
     return frame
 
 
-def calc_frame_diff_rate(frame1, frame2):
-    # can not use np.abs because of uint8 overflow
-    frame_diff = np.minimum(np.subtract(frame1, frame2), np.subtract(frame2, frame1))
-    frame_diff_bin = np.where(frame_diff <= PIXEL_DIFF_THRESH, 0, 1)
-    diff_rate = frame_diff_bin.sum() / frame_diff_bin.size
+def iter_frames(cap, start_sec, end_sec, seek=False):
+    """
+    yield (sec, frame) for each second in [start_sec, end_sec)
+    frames are decoded sequentially and only one frame per second is retrieved, unless seek is True
+    """
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if seek:
+        for sec in range(start_sec, end_sec):
+            yield sec, get_frame(cap, sec)
+        return
+
+    frame_idx = round(start_sec * fps)
+    if frame_idx > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+    for sec in range(start_sec, end_sec):
+        target_idx = round(sec * fps)
+        while frame_idx < target_idx:
+            # grab() skips decoding into a numpy array, which is most of the cost of read()
+            if not cap.grab():
+                LOGGER.warning(f'failed to grab frame {frame_idx}')
+                return
+            frame_idx += 1
+        ret, frame = cap.read()
+        if not ret:
+            LOGGER.warning(f'failed to read frame {frame_idx}')
+            return
+        frame_idx += 1
+        yield sec, frame
+
+
+def preprocess_frame(frame, width):
+    """
+    convert frame to grayscale and downscale to the given width to reduce the cost of diff
+    """
+
+    if width and frame.shape[1] > width:
+        height = round(frame.shape[0] * width / frame.shape[1])
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def calc_frame_diff_rate(frame1, frame2, buffer=None):
+    # cv2.absdiff saturates instead of overflowing uint8, and the threshold is applied in place
+    frame_diff = cv2.absdiff(frame1, frame2, dst=buffer)
+    cv2.threshold(frame_diff, PIXEL_DIFF_THRESH, 1, cv2.THRESH_BINARY, dst=frame_diff)
+    diff_rate = np.count_nonzero(frame_diff) / frame_diff.size
     return diff_rate
 
 
-def main(video_fp, diff_fp):
-    LOGGER.info(f'load {video_fp}')
-    cap = cv2.VideoCapture(video_fp)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    duration = int(frame_count / fps)
-    LOGGER.info(f'fps={fps}, frames={frame_count}, duration={duration}')
+def calc_diff_records(video_fp, start_sec, end_sec, width, seek=False, progress=False):
+    """
+    calculate diff rate for each second in [start_sec, end_sec) with its own VideoCapture
+    the frame at start_sec - 1 is also decoded so that the first diff is the same as the serial run
+    """
 
+    cap = cv2.VideoCapture(video_fp)
     records = []
-    prev_frame = get_frame(cap, 0)
-    for sec in tqdm(range(duration)):
-        frame = get_frame(cap, sec)
-        records.append({
-            'sec': sec,
-            'diff': calc_frame_diff_rate(prev_frame, frame)
-        })
+    prev_frame, buffer = None, None
+    frames = iter_frames(cap, max(start_sec - 1, 0), end_sec, seek)
+    for sec, frame in tqdm(frames, total=end_sec - start_sec, disable=not progress):
+        frame = preprocess_frame(frame, width)
+        if prev_frame is None:
+            prev_frame, buffer = frame, np.empty_like(frame)
+        if sec >= start_sec:
+            records.append({
+                'sec': sec,
+                'diff': calc_frame_diff_rate(prev_frame, frame, buffer)
+            })
         prev_frame = frame
+    cap.release()
+    return records
+
+
+def calc_diff_records_parallel(video_fp, duration, width, seek, chunk_sec, num_workers):
+    """
+    split the video into chunks of chunk_sec seconds and calculate diff records in a process pool
+    records are stitched in order, and truncated at the first chunk that ended early as the serial run does
+    """
+
+    ranges = [(start_sec, min(start_sec + chunk_sec, duration)) for start_sec in range(0, duration, chunk_sec)]
+    LOGGER.info(f'split into {len(ranges)} chunks')
+    records = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(calc_diff_records, video_fp, start_sec, end_sec, width, seek)
+                   for start_sec, end_sec in ranges]
+        for (start_sec, end_sec), future in tqdm(zip(ranges, futures), total=len(ranges)):
+            chunk_records = future.result()
+            records += chunk_records
+            if len(chunk_records) < end_sec - start_sec:
+                LOGGER.warning(f'chunk [{start_sec}, {end_sec}) ended at {start_sec + len(chunk_records)}')
+                for pending_future in futures:
+                    pending_future.cancel()
+                break
+    return records
+
+
+def probe_frame_size(video_url):
+    command = ['ffprobe', '-v', 'error', *FFMPEG_INPUT_OPTIONS, '-select_streams', 'v:0',
+               '-show_entries', 'stream=width,height', '-of', 'json', video_url]
+    stream = json.loads(subprocess.run(command, check=True, capture_output=True).stdout)['streams'][0]
+    return stream['width'], stream['height']
+
+
+def stream_diff_records(video_url, voice_fp, width):
+    """
+    decode the video once with ffmpeg, encoding the audio to voice_fp and piping one grayscale frame per second
+    so that neither the video nor the audio needs to be read again from a local mp4
+    frames are sampled by the fps filter of ffmpeg, so diff rates may slightly differ from calc_diff_records
+    """
+
+    frame_width, frame_height = probe_frame_size(video_url)
+    if width and frame_width > width:
+        frame_width, frame_height = width, round(frame_height * width / frame_width)
+    frame_size = frame_width * frame_height
+    LOGGER.info(f'stream {frame_width}x{frame_height} frames from {video_url}')
+
+    command = ['ffmpeg', '-nostdin', '-loglevel', 'warning', *FFMPEG_INPUT_OPTIONS, '-i', video_url,
+               '-map', '0:a:0', '-ar', '44100', '-ac', '1', '-y', voice_fp,
+               '-map', '0:v:0', '-vf', f'fps=1,scale={frame_width}:{frame_height}:flags=area,format=gray',
+               '-f', 'rawvideo', 'pipe:1']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=frame_size)
+    records = []
+    prev_frame, buffer = None, np.empty((frame_height, frame_width), dtype=np.uint8)
+    with tqdm() as pbar:
+        while True:
+            data = process.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            frame = np.frombuffer(data, dtype=np.uint8).reshape(frame_height, frame_width)
+            if prev_frame is None:
+                prev_frame = frame
+            records.append({
+                'sec': len(records),
+                'diff': calc_frame_diff_rate(prev_frame, frame, buffer)
+            })
+            prev_frame = frame
+            pbar.update()
+    process.stdout.close()
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    LOGGER.info(f'saved {voice_fp}')
+    return records
+
+
+def main(video_fp, diff_fp):
+    if args.voice:
+        records = stream_diff_records(video_fp, args.voice, args.width)
+    else:
+        LOGGER.info(f'load {video_fp}')
+        cap = cv2.VideoCapture(video_fp)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        duration = int(frame_count / fps)
+        cap.release()
+        LOGGER.info(f'fps={fps}, frames={frame_count}, duration={duration}')
+        if args.workers > 1:
+            records = calc_diff_records_parallel(video_fp, duration, args.width, args.seek, args.chunk_sec,
+                                                 args.workers)
+        else:
+            records = calc_diff_records(video_fp, 0, duration, args.width, args.seek, progress=True)
     df = pd.DataFrame(records, columns=['sec', 'diff'])
     df.to_csv(diff_fp, index=False)
     LOGGER.info(f'saved {diff_fp}')
@@ -49,8 +189,13 @@ def main(video_fp, diff_fp):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='１秒ごとに前のフレームとの差分率を算出してCSVに保存する')
-    parser.add_argument('--video', help='動画ファイル（mp4）', required=True)
+    parser.add_argument('--video', help='動画ファイル（mp4）、--voiceを指定する場合は動画のURLでもよい', required=True)
     parser.add_argument('--diff', help='差分ファイル（csv）', required=True)
+    parser.add_argument('--width', help='差分を計算する前にフレームを縮小する幅（0の場合は縮小しない）', type=int, default=320)
+    parser.add_argument('--seek', help='フレームを順番にデコードせずに１秒ごとにシークする', action='store_true')
+    parser.add_argument('-w', '--workers', help='動画を分割して並列に処理するプロセス数', type=int, default=1)
+    parser.add_argument('--chunk_sec', help='並列に処理する際の分割の長さ（秒）', type=int, default=600)
+    parser.add_argument('--voice', help='指定した場合は動画を一度だけデコードして音声ファイル（mp3）も保存する')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
@@ -1,14 +1,21 @@
 import argparse
+import hashlib
+import json
 import logging
+import os
 import re
+from pathlib import Path
+from typing import List
 
 from sgqlc.operation import Operation
 from tqdm import tqdm
 
 from politylink.elasticsearch.client import ElasticsearchClient, OpType
-from politylink.elasticsearch.schema import BillText, BillCategory, BillStatus, ParliamentaryGroup, MemberText, House
+from politylink.elasticsearch.schema import BillText, BillCategory, BillStatus, ParliamentaryGroup, MemberText, House, \
+    to_cls
 from politylink.graphql.client import GraphQLClient, Query
 from politylink.graphql.schema import _BillFilter, Bill, Member, _MemberFilter
+from snapshot import GraphQLSnapshot
 
 LOGGER = logging.getLogger(__name__)
 gql_client = GraphQLClient(url='https://graphql.politylink.jp')
@@ -16,30 +23,77 @@ es_client = ElasticsearchClient()
 
 
 class ElasticsearchSyncer:
-    def __init__(self, gql_client: GraphQLClient, es_client: ElasticsearchClient):
+    def __init__(self, gql_client: GraphQLClient, es_client: ElasticsearchClient, fingerprints=None):
         self.gql_client = gql_client
         self.es_client = es_client
+        self.fingerprints = fingerprints if fingerprints is not None else dict()
         self.sync_count = 0
+        self.unchanged_count = 0
+        self.fail_count = 0
 
     def sync(self, id_):
         """
         GraphQLのデータをElasticsearchに同期する
+        前回同期時からGraphQLのデータもElasticsearchのドキュメントも変化していない場合はスキップする
         """
 
-        if not self.es_client.exists(id_):
-            LOGGER.debug(f'skipped {id_}')
-            return False
-        gql_obj = self.fetch(id_)
-        es_obj = self.convert(gql_obj)
-        self.es_client.index(es_obj, op_type=OpType.UPDATE)
-        LOGGER.debug(f'synced {id_}')
-        self.sync_count += 1
-        return True
+        return self.bulk_sync([id_]) > 0
+
+    def bulk_sync(self, ids):
+        """
+        複数のGraphQLのデータをまとめてElasticsearchに同期する
+        GraphQLとElasticsearchへのリクエストはそれぞれ1回にまとめる（更新後のversion取得を除く）
+        """
+
+        id2version = self.bulk_get_versions(ids)
+        for id_ in ids:
+            if id_ not in id2version:
+                # the document was deleted or the index was rebuilt
+                self.fingerprints.pop(id_, None)
+        target_ids = [id_ for id_ in ids if id_ in id2version]
+        LOGGER.debug(f'skipped {len(ids) - len(target_ids)} ids')
+        if not target_ids:
+            return 0
+
+        es_objs, id2fingerprint = [], dict()
+        for gql_obj in self.bulk_fetch(target_ids):
+            fingerprint = calc_fingerprint(gql_obj)
+            if self.fingerprints.get(gql_obj.id) == {'hash': fingerprint, 'version': id2version[gql_obj.id]}:
+                LOGGER.debug(f'{gql_obj.id} is unchanged')
+                self.unchanged_count += 1
+                continue
+            es_objs.append(self.convert(gql_obj))
+            id2fingerprint[gql_obj.id] = fingerprint
+        if es_objs:
+            self.es_client.bulk_index(es_objs, op_type=OpType.UPDATE)
+            # record versions after our update, so that documents rewritten by others are synced again
+            new_id2version = self.bulk_get_versions(list(id2fingerprint))
+            for id_, fingerprint in id2fingerprint.items():
+                if id_ in new_id2version:
+                    self.fingerprints[id_] = {'hash': fingerprint, 'version': new_id2version[id_]}
+            LOGGER.debug(f'synced {len(es_objs)} ids')
+        self.sync_count += len(es_objs)
+        return len(es_objs)
+
+    def bulk_get_versions(self, ids):
+        """
+        Elasticsearchに存在するIDとそのversionをmulti-getで取得する
+        """
+
+        res = self.es_client.client.mget(index=to_cls(ids[0]).index, body={'ids': ids}, _source=False)
+        return {doc['_id']: doc['_version'] for doc in res['docs'] if doc.get('found')}
 
     def fetch(self, id_):
         """
         GraphQLから必要なFieldを取得する
         """
+
+        return self.bulk_fetch([id_])[0]
+
+    def bulk_fetch(self, ids):
+        """
+        GraphQLから必要なFieldを複数IDについてまとめて取得する
+        """
         NotImplemented
 
     def convert(self, gql_obj):
@@ -61,9 +115,9 @@ class BillSyncer(ElasticsearchSyncer):
         Bill.aliases: BillText.Field.ALIASES
     }
 
-    def fetch(self, bill_id) -> Bill:
+    def bulk_fetch(self, bill_ids) -> List[Bill]:
         op = Operation(Query)
-        bills = op.bill(filter=_BillFilter({'id': bill_id}))
+        bills = op.bill(filter=_BillFilter({'id_in': bill_ids}))
 
         for field in self.GQL_ROOT_FIELDS + self.GQL_DATE_FIELDS:
             getattr(bills, field)()
@@ -78,8 +132,7 @@ class BillSyncer(ElasticsearchSyncer):
         members.group()
 
         res = self.gql_client.endpoint(op)
-        data = (op + res).bill
-        return data[0]
+        return (op + res).bill
 
     def convert(self, bill: Bill) -> BillText:
         bill_text = BillText()
@@ -127,9 +180,9 @@ class MemberSyncer(ElasticsearchSyncer):
         Member.name_hira: MemberText.Field.NAME_HIRA
     }
 
-    def fetch(self, member_id) -> Member:
+    def bulk_fetch(self, member_ids) -> List[Member]:
         op = Operation(Query)
-        members = op.member(filter=_MemberFilter({'id': member_id}))
+        members = op.member(filter=_MemberFilter({'id_in': member_ids}))
 
         for field in self.GQL_FIELDS:
             getattr(members, field)()
@@ -139,8 +192,7 @@ class MemberSyncer(ElasticsearchSyncer):
         activities.datetime()
 
         res = self.gql_client.endpoint(op)
-        data = (op + res).member
-        return data[0]
+        return (op + res).member
 
     def convert(self, member: Member) -> MemberText:
         member_text = MemberText()
@@ -175,6 +227,53 @@ def to_es_groups(gql_groups):
     return [ParliamentaryGroup.from_gql(gql_group).index for gql_group in gql_groups if gql_group]
 
 
+def sync_all(syncer, ids):
+    """
+    sync ids in batches, and continue with the next batch if one fails
+    """
+
+    for i in tqdm(range(0, len(ids), args.batch_size)):
+        batch_ids = ids[i:i + args.batch_size]
+        try:
+            syncer.bulk_sync(batch_ids)
+        except Exception:
+            LOGGER.exception(f'failed to sync {len(batch_ids)} ids from {batch_ids[0]}')
+            syncer.fail_count += len(batch_ids)
+            for id_ in batch_ids:
+                syncer.fingerprints.pop(id_, None)
+
+
+def calc_fingerprint(gql_obj):
+    """
+    calculate a hash of the GraphQL response used for the conversion
+    """
+
+    json_str = json.dumps(gql_obj.__json_data__, ensure_ascii=False, sort_keys=True)
+    return hashlib.md5(json_str.encode('utf-8')).hexdigest()
+
+
+def load_fingerprints(json_fp):
+    """
+    load fingerprints ({'hash': GraphQL response hash, 'version': Elasticsearch document version}) of synced ids
+    """
+
+    if args.force:
+        LOGGER.info(f'ignored {json_fp} to force full sync')
+        return dict()
+    if os.path.exists(json_fp):
+        with open(json_fp, 'r') as f:
+            return json.load(f)
+    else:
+        LOGGER.warning(f'{json_fp} does not exist')
+        return dict()
+
+
+def save_fingerprints(fingerprints, json_fp):
+    Path(json_fp).parent.mkdir(parents=True, exist_ok=True)
+    with open(json_fp, 'w') as f:
+        json.dump(fingerprints, f)
+
+
 def extract_diet_number(bill_number):
     pattern = r'第([0-9]+)回'
     m = re.search(pattern, bill_number)
@@ -182,23 +281,33 @@ def extract_diet_number(bill_number):
 
 
 def main_bill():
-    bills = gql_client.get_all_bills(fields=['id'])
+    snapshot = GraphQLSnapshot(gql_client, run_id=args.run_id)
+    bills = snapshot.get_all_bills(fields=['id'])
     LOGGER.info(f'fetched {len(bills)} bills from GraphQL')
 
-    bill_syncer = BillSyncer(gql_client, es_client)
-    for bill in tqdm(bills):
-        bill_syncer.sync(bill.id)
-    LOGGER.info(f'synced {bill_syncer.sync_count}/{len(bills)} bills to Elasticsearch')
+    json_fp = f'{args.fingerprint_dir}/bill.json'
+    bill_syncer = BillSyncer(gql_client, es_client, load_fingerprints(json_fp))
+    try:
+        sync_all(bill_syncer, [bill.id for bill in bills])
+    finally:
+        save_fingerprints(bill_syncer.fingerprints, json_fp)
+    LOGGER.info(f'synced {bill_syncer.sync_count}/{len(bills)} bills to Elasticsearch '
+                f'({bill_syncer.unchanged_count} unchanged, {bill_syncer.fail_count} failed)')
 
 
 def main_member():
-    members = gql_client.get_all_members(fields=['id'])
+    snapshot = GraphQLSnapshot(gql_client, run_id=args.run_id)
+    members = snapshot.get_all_members(fields=['id'])
     LOGGER.info(f'fetched {len(members)} members from GraphQL')
 
-    member_syncer = MemberSyncer(gql_client, es_client)
-    for bill in tqdm(members):
-        member_syncer.sync(bill.id)
-    LOGGER.info(f'synced {member_syncer.sync_count}/{len(members)} members to Elasticsearch')
+    json_fp = f'{args.fingerprint_dir}/member.json'
+    member_syncer = MemberSyncer(gql_client, es_client, load_fingerprints(json_fp))
+    try:
+        sync_all(member_syncer, [member.id for member in members])
+    finally:
+        save_fingerprints(member_syncer.fingerprints, json_fp)
+    LOGGER.info(f'synced {member_syncer.sync_count}/{len(members)} members to Elasticsearch '
+                f'({member_syncer.unchanged_count} unchanged, {member_syncer.fail_count} failed)')
 
 
 def main():
@@ -212,6 +321,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='GraphQLのメタデータをElasticsearchに同期する')
     parser.add_argument('-b', '--bill', help='Billを同期する', action='store_true')
     parser.add_argument('-m', '--member', help='Memberを同期する', action='store_true')
+    parser.add_argument('-d', '--fingerprint_dir', help='同期済みデータのハッシュを保存するディレクトリ',
+                        default='./elasticsearch')
+    parser.add_argument('-f', '--force', help='変更がなくても全てのデータを同期する', action='store_true')
+    parser.add_argument('-n', '--batch_size', help='1回のリクエストで同期するデータ数', type=int, default=100)
+    parser.add_argument('--run_id', help='同じIDで保存されたGraphQLのスナップショットを再利用する（cron.pyが指定する）')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
@@ -2,8 +2,10 @@ import argparse
 import json
 import logging
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
+from utils import HttpClient
 
 LOGGER = logging.getLogger(__name__)
 
@@ -12,29 +14,41 @@ class SpeechRestClient:
     """
     REST client to access GCP Speech-to-Text results
     https://cloud.google.com/speech-to-text/docs/reference/rest
+    the API key is sent in a header, so that it does not appear in URLs of logs and exceptions
     """
 
-    def __init__(self):
+    def __init__(self, base_url='https://speech.googleapis.com/v1', http_client=None):
         self.api_key = os.environ['GCP_API_KEY']
+        self.base_url = base_url.rstrip('/')
+        self.http_client = http_client if http_client else HttpClient()
 
-    def list(self):
+    def request(self, path, params=None):
+        response = self.http_client.get(f'{self.base_url}/{path}', params=params,
+                                        headers={'X-Goog-Api-Key': self.api_key})
+        if not response.ok:
+            raise ValueError(f'failed to get {path}: status={response.status_code}')
+        return response.json()
+
+    def list(self, page_size=100):
         """
         return currently available operation names
         """
 
-        url = f'https://speech.googleapis.com/v1/operations?key={self.api_key}'
-        response = requests.get(url)
-        data = response.json()
-        return list(map(lambda x: x['name'], data['operations']))
+        op_names = []
+        params = {'pageSize': page_size}
+        while True:
+            data = self.request('operations', params)
+            op_names += list(map(lambda x: x['name'], data.get('operations', [])))
+            if not data.get('nextPageToken'):
+                return op_names
+            params['pageToken'] = data['nextPageToken']
 
     def get(self, op_name):
         """
         return finished operation result
         """
 
-        url = f'https://speech.googleapis.com/v1/operations/{op_name}?key={self.api_key}'
-        response = requests.get(url)
-        data = response.json()
+        data = self.request(f'operations/{op_name}')
 
         if ('done' not in data) or (not data['done']):
             raise ValueError('operation is not finished')
@@ -46,27 +60,65 @@ class SpeechRestClient:
         return data
 
 
+def load_op2job(index_fp):
+    if not os.path.exists(index_fp):
+        return dict()
+    with open(index_fp, 'r') as f:
+        return json.load(f)
+
+
+def save_op2job(index_fp, op2job):
+    with open(index_fp, 'w') as f:
+        json.dump(op2job, f, indent=2)
+
+
+def fetch_result(speech_client, op_name):
+    data = speech_client.get(op_name)
+    job_id = data['metadata']['job_id']
+    json_fp = f'./voice/{job_id}.json'
+    with open(json_fp, 'w') as f:
+        json.dump(data, f, ensure_ascii=False)
+    LOGGER.info(f'saved JSON result of {op_name} in {json_fp}')
+    return job_id
+
+
 def main():
-    speech_client = SpeechRestClient()
+    http_client = HttpClient(timeout=args.timeout, pool_size=args.workers)
+    speech_client = SpeechRestClient(args.base_url, http_client)
 
     op_names = speech_client.list()
-    LOGGER.info(f'found total {len(op_names)} operations: {op_names}')
-
-    for op_name in op_names:
-        try:
-            data = speech_client.get(op_name)
-        except Exception as e:
-            LOGGER.warning(f'failed to fetch operation result for {op_name}: {e}')
-            continue
-        LOGGER.info(f'fetched transcription result for {op_name}')
-        json_fp = f'./voice/{data["metadata"]["job_id"]}.json'
-        with open(json_fp, 'w') as f:
-            json.dump(data, f, ensure_ascii=False)
-        LOGGER.info(f'saved JSON result in {json_fp}')
+    LOGGER.info(f'found total {len(op_names)} operations')
+
+    # operation name -> job id of results already saved, so that finished operations are not fetched again
+    index_fp = './voice/operations.json'
+    op2job = load_op2job(index_fp)
+    # operations unknown to the index are always fetched since their job ids are not known yet
+    target_op_names = [op_name for op_name in op_names
+                       if args.overwrite or op_name not in op2job
+                       or not os.path.exists(f'./voice/{op2job[op_name]}.json')]
+    LOGGER.info(f'fetch {len(target_op_names)} operations ({len(op_names) - len(target_op_names)} already saved)')
+
+    stats = defaultdict(int)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        future2op = {executor.submit(fetch_result, speech_client, op_name): op_name for op_name in target_op_names}
+        for future in as_completed(future2op):
+            op_name = future2op[future]
+            try:
+                op2job[op_name] = future.result()
+                stats['saved'] += 1
+            except Exception as e:
+                LOGGER.warning(f'failed to fetch operation result for {op_name}: {e}')
+                stats['pending'] += 1
+    save_op2job(index_fp, op2job)
+    LOGGER.info('saved {} results, {} operations are pending or failed'.format(stats['saved'], stats['pending']))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='GCPの文字起こしAPIの結果をRESTで取得する')
+    parser.add_argument('-o', '--overwrite', help='既に保存済の結果も取得する', action='store_true')
+    parser.add_argument('-w', '--workers', help='結果を並列に取得するスレッド数', type=int, default=8)
+    parser.add_argument('--timeout', help='リクエストのタイムアウト（秒）', type=float, default=30)
+    parser.add_argument('--base_url', help='Speech-to-Text APIのベースURL', default='https://speech.googleapis.com/v1')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
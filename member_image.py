@@ -1,14 +1,18 @@
 import argparse
+import hashlib
 import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
-import requests
-import time
+from botocore.exceptions import ClientError
 from tqdm import tqdm
 
 from politylink.graphql.client import GraphQLClient
+from utils import HttpClient, HostRateLimiter
 
 LOGGER = logging.getLogger(__name__)
+BUCKET = 'politylink'
 
 """
 requires ~/.aws/credentials
@@ -16,21 +20,79 @@ https://boto3.amazonaws.com/v1/documentation/api/latest/guide/quickstart.html
 """
 
 
+def get_object_key(member):
+    return 'member/{}.jpg'.format(member.id.split(':')[-1])
+
+
+def get_metadata(s3_client, object_key):
+    """
+    return user metadata of the S3 object, or None if the object does not exist
+    """
+
+    try:
+        return s3_client.head_object(Bucket=BUCKET, Key=object_key)['Metadata']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+            return None
+        raise
+
+
+def mirror_image(s3_client, http_client, host_limiter, member):
+    """
+    upload the member image to S3 if the source URL or the content has changed
+    :return: 'uploaded' or 'unchanged'
+    """
+
+    object_key = get_object_key(member)
+    metadata = get_metadata(s3_client, object_key) or dict()
+
+    response = http_client.get(member.image, limiter=host_limiter.get(member.image))
+    if not response.ok:
+        raise ValueError(f'failed to fetch {member.image}: status={response.status_code}')
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if metadata.get('source-url') == member.image and metadata.get('content-hash') == content_hash:
+        LOGGER.debug(f'{object_key} is unchanged')
+        return 'unchanged'
+
+    s3_client.put_object(Bucket=BUCKET, Key=object_key, Body=response.content, ContentType='image/jpeg',
+                         Metadata={'source-url': member.image, 'content-hash': content_hash})
+    LOGGER.debug(f'uploaded {object_key}')
+    return 'uploaded'
+
+
 def main():
     client = GraphQLClient(url="https://graphql.politylink.jp/")
     members = client.get_all_members(fields=['id', 'image'])
-    s3 = boto3.resource('s3')
-    for member in tqdm(members):
-        response = requests.get(member.image)
-        object_key = 'member/{}.jpg'.format(member.id.split(':')[-1])
-        s3.Bucket('politylink').put_object(Key=object_key, Body=response.content, ContentType="image/jpeg")
-        time.sleep(1)
+    members = [member for member in members if member.image]
+    s3_client = boto3.client('s3')
+    http_client = HttpClient(pool_size=args.workers)
+    host_limiter = HostRateLimiter(args.interval)
+
+    stats = defaultdict(int)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        future2member = {executor.submit(mirror_image, s3_client, http_client, host_limiter, member): member
+                         for member in members}
+        for future in tqdm(as_completed(future2member), total=len(future2member)):
+            member = future2member[future]
+            try:
+                stats[future.result()] += 1
+            except Exception:
+                LOGGER.exception(f'failed to mirror image of {member.id}')
+                stats['failed'] += 1
+    LOGGER.info('processed {} members ({} uploaded, {} unchanged, {} failed)'.format(
+        len(members), stats['uploaded'], stats['unchanged'], stats['failed']
+    ))
+    http_client.log_stats(LOGGER)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='ImageをS3にアップロードする')
+    parser.add_argument('-w', '--workers', help='画像のダウンロードとS3へのアップロードのスレッド数', type=int, default=4)
+    parser.add_argument('--interval', help='同じホストへのリクエストの最小間隔（秒）', type=float, default=1)
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
+
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     logging.getLogger('sgqlc').setLevel(logging.INFO)
+    logging.getLogger('botocore').setLevel(logging.WARNING)
     main()
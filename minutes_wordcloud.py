@@ -1,8 +1,12 @@
 import argparse
+import hashlib
 import json
 import logging
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import date
+from multiprocessing import get_context
 from pathlib import Path
 
 import boto3
@@ -11,10 +15,13 @@ from tqdm import tqdm
 from wordcloud import WordCloud
 
 from politylink.elasticsearch.client import ElasticsearchClient, ElasticsearchException
+from politylink.elasticsearch.schema import MinutesText
 from politylink.graphql.client import GraphQLClient
 from politylink.graphql.schema import Minutes
 from politylink.nlp.utils import filter_by_pos, WORDCLOUD_POS_TAGS, STOPWORDS
 from politylink.utils import filter_dict_by_value
+from snapshot import GraphQLSnapshot
+from tfidf_store import TfidfStore
 from utils import date_type
 
 LOGGER = logging.getLogger(__name__)
@@ -31,46 +38,148 @@ WORDCLOUD_PARAMS = {
 gql_client = GraphQLClient()
 s3_client = boto3.client('s3')
 es_client = ElasticsearchClient()
+TERM2VALID = dict()  # memo of POS and stopword filtering, shared among batches
 
 
-def fetch_term_statistics(minutes_id):
+def fetch_raw_term_statistics(minutes_ids):
+    """
+    fetch term statistics of multiple minutes with one multi termvectors request
+    same as ElasticsearchClient.get_term_statistics except that minutes not found in Elasticsearch are empty
+    :return: dictionary of minutes id to (dictionary of term to statistics (tf, idf, tfidf))
+    """
+
+    try:
+        res = es_client.client.mtermvectors(index=MinutesText.index, body={
+            'ids': minutes_ids,
+            'parameters': {'fields': ['body'], 'term_statistics': True}
+        })
+    except Exception as e:
+        raise ElasticsearchException(f'failed to get termvectors for {len(minutes_ids)} minutes') from e
+
+    id2term2stats = {minutes_id: dict() for minutes_id in minutes_ids}
+    for doc in res['docs']:
+        if 'body' not in doc.get('term_vectors', {}):
+            continue
+        term2stats = id2term2stats[doc['_id']]
+        doc_count = doc['term_vectors']['body']['field_statistics']['doc_count']
+        for term, stats_raw in doc['term_vectors']['body']['terms'].items():
+            stats = dict()
+            stats['tf'] = stats_raw['term_freq']
+            stats['idf'] = math.log(doc_count / stats_raw['doc_freq'])
+            stats['tfidf'] = stats['tf'] * stats['idf']
+            term2stats[term] = stats
+    return id2term2stats
+
+
+def fetch_term_statistics(minutes_ids):
     """
     fetch term statistics from Elasticsearch and apply filtering for wordcloud
+    """
+
+    return filter_term_statistics(fetch_raw_term_statistics(minutes_ids))
+
+
+def filter_term_statistics(id2term2stats_raw):
+    """
+    apply filtering for wordcloud to raw term statistics
+    POS tagging is applied once per distinct term, since the vocabulary largely overlaps among minutes
+    POS tagger is not thread-safe, so this must be called only from the main thread
     for storage efficiency, stats are compressed to two value tuple: (tf, tfidf)
     """
 
-    term2stats = dict()
-    term2stats_raw = es_client.get_term_statistics(minutes_id)
-    terms = filter_by_pos(term2stats_raw.keys(), WORDCLOUD_POS_TAGS)
-    terms = set(terms) - STOPWORDS
-    for term in terms:
-        stats = term2stats_raw[term]
-        if stats['tf'] > 1:
-            term2stats[term] = (stats['tf'], round(stats['tfidf'], 2))
-    return term2stats
+    new_terms = set()
+    for term2stats_raw in id2term2stats_raw.values():
+        new_terms.update(term for term in term2stats_raw if term not in TERM2VALID)
+    new_terms = list(new_terms)
+    valid_terms = set(filter_by_pos(new_terms, WORDCLOUD_POS_TAGS)) - STOPWORDS
+    for term in new_terms:
+        TERM2VALID[term] = term in valid_terms
 
+    id2term2stats = dict()
+    for minutes_id, term2stats_raw in id2term2stats_raw.items():
+        term2stats = dict()
+        for term, stats in term2stats_raw.items():
+            if TERM2VALID[term] and stats['tf'] > 1:
+                term2stats[term] = (stats['tf'], round(stats['tfidf'], 2))
+        id2term2stats[minutes_id] = term2stats
+    return id2term2stats
 
-def process(minutes_id, term2stats):
-    LOGGER.debug(f'process {minutes_id}')
 
+def load_term_statistics(minutes_ids, raw_future=None):
+    """
+    wrapper of fetch_term_statistics that returns None for failed or empty minutes instead of raising exception
+    :param raw_future: future of fetch_raw_term_statistics if it was already submitted to a thread pool
+    """
+
+    try:
+        id2term2stats_raw = raw_future.result() if raw_future else fetch_raw_term_statistics(minutes_ids)
+        id2term2stats = filter_term_statistics(id2term2stats_raw)
+    except Exception:
+        LOGGER.exception(f'failed to load term statistics for {minutes_ids}')
+        return {minutes_id: None for minutes_id in minutes_ids}
+    for minutes_id, term2stats in id2term2stats.items():
+        if not term2stats:
+            LOGGER.warning(f'term statistic is empty for {minutes_id}')
+            id2term2stats[minutes_id] = None
+    return id2term2stats
+
+
+def build_tfidf(term2stats):
     tfidf = dict(map(lambda x: (x[0], x[1][1]), term2stats.items()))
-    tfidf = filter_dict_by_value(tfidf, num_items=30)
+    return filter_dict_by_value(tfidf, num_items=30)
+
+
+def calc_tfidf_hash(term2stats):
+    """
+    calculate a hash of the tfidf dict used for wordcloud rendering
+    """
+
+    json_str = json.dumps(build_tfidf(term2stats), ensure_ascii=False, sort_keys=True)
+    return hashlib.md5(json_str.encode('utf-8')).hexdigest()
+
+
+def is_unchanged(minutes_id, tfidf_hash, id2hash):
+    """
+    return True if the same wordcloud was already rendered (and published if --publish)
+    """
+
+    if args.overwrite or minutes_id not in id2hash:
+        return False
+    prev = id2hash[minutes_id]
+    return prev['hash'] == tfidf_hash and (prev['published'] or not args.publish)
+
+
+def render_wordcloud(minutes_id, term2stats):
+    """
+    CPU-bound part of process, which can be run in a separate process
+    """
+
+    tfidf = build_tfidf(term2stats)
 
     id_ = minutes_id.split(':')[-1]
     local_path = f'./wordcloud/minutes/{id_}.jpg'
-    s3_path = f'minutes/{id_}.jpg'
-
     wordcloud = WordCloud(**WORDCLOUD_PARAMS).generate_from_frequencies(tfidf)
     wordcloud.to_file(local_path)
-    LOGGER.info(f'saved wordcloud to {local_path}')
+    return local_path
+
+
+def publish_wordcloud(minutes_id, local_path):
+    id_ = minutes_id.split(':')[-1]
+    s3_path = f'minutes/{id_}.jpg'
+    s3_client.upload_file(local_path, 'politylink', s3_path, ExtraArgs={'ContentType': 'image/jpeg'})
+    gql_client.merge(Minutes({
+        'id': minutes_id,
+        'wordcloud': f'https://image.politylink.jp/{s3_path}'
+    }))
+    LOGGER.info(f'published wordcloud to {s3_path}')
+
 
+def process(minutes_id, term2stats):
+    LOGGER.debug(f'process {minutes_id}')
+    local_path = render_wordcloud(minutes_id, term2stats)
+    LOGGER.info(f'saved wordcloud to {local_path}')
     if args.publish:
-        s3_client.upload_file(local_path, 'politylink', s3_path, ExtraArgs={'ContentType': 'image/jpeg'})
-        gql_client.merge(Minutes({
-            'id': minutes_id,
-            'wordcloud': f'https://image.politylink.jp/{s3_path}'
-        }))
-        LOGGER.info(f'published wordcloud to {s3_path}')
+        publish_wordcloud(minutes_id, local_path)
 
 
 def is_target_minutes(minutes):
@@ -99,6 +208,20 @@ def save_all_data(all_data, json_fp):
         json.dump(all_data, f, ensure_ascii=False)
 
 
+def load_tfidf_store(db_fp):
+    """
+    load TfidfStore, importing the legacy JSON file with the same name if the store is empty
+    """
+
+    store = TfidfStore(db_fp)
+    json_fp = str(Path(db_fp).with_suffix('.json'))
+    if len(store) == 0 and os.path.exists(json_fp):
+        store.update(load_all_data(json_fp))
+        store.commit()
+        LOGGER.info(f'imported {len(store)} data from {json_fp} to {db_fp}')
+    return store
+
+
 def post_all_date(json_fp):
     requests.post(
         f'{WORDCLOUD_SERVER}/load',
@@ -107,39 +230,134 @@ def post_all_date(json_fp):
     )
 
 
+def start_process_pool(max_workers):
+    """
+    return a fork-based ProcessPoolExecutor whose workers are already forked
+    workers must be forked before any thread starts, since forking a process with live threads may deadlock
+    spawn is not used since it re-imports this script in each worker, which loads the POS tagger and clients
+    """
+
+    executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context('fork'))
+    executor.submit(int).result()  # all workers are forked on the first submission
+    return executor
+
+
+def process_parallel(minutes_list, all_data, id2hash):
+    """
+    run Elasticsearch fetch and S3 upload in a thread pool and wordcloud rendering in a process pool
+    POS filtering runs in the main thread, and results are stored to all_data in the order of minutes_list
+    """
+
+    # the process pool is started first so that no I/O thread is running when workers are forked
+    with start_process_pool(os.cpu_count()) as cpu_executor, \
+            ThreadPoolExecutor(max_workers=args.io_workers) as io_executor:
+        batches = [minutes_list[i:i + args.batch_size] for i in range(0, len(minutes_list), args.batch_size)]
+        raw_futures = [io_executor.submit(fetch_raw_term_statistics, [minutes.id for minutes in batch])
+                       for batch in batches]
+        id2render_future = dict()
+        for batch, raw_future in zip(batches, raw_futures):
+            id2term2stats = load_term_statistics([minutes.id for minutes in batch], raw_future)
+            for minutes in batch:
+                term2stats = id2term2stats[minutes.id]
+                if term2stats is None:
+                    continue
+                all_data[minutes.id] = term2stats
+                tfidf_hash = calc_tfidf_hash(term2stats)
+                if is_unchanged(minutes.id, tfidf_hash, id2hash):
+                    LOGGER.debug(f'wordcloud is unchanged for {minutes.id}')
+                    continue
+                render_future = cpu_executor.submit(render_wordcloud, minutes.id, term2stats)
+                id2render_future[minutes.id] = (render_future, tfidf_hash)
+
+        id2publish_future = dict()
+        for minutes_id, (render_future, tfidf_hash) in tqdm(id2render_future.items()):
+            try:
+                local_path = render_future.result()
+            except Exception:
+                LOGGER.exception(f'failed to render wordcloud for {minutes_id}')
+                continue
+            LOGGER.info(f'saved wordcloud to {local_path}')
+            if args.publish:
+                id2publish_future[minutes_id] = io_executor.submit(publish_wordcloud, minutes_id, local_path)
+            else:
+                id2hash[minutes_id] = {'hash': tfidf_hash, 'published': False}
+
+        for minutes_id, publish_future in id2publish_future.items():
+            try:
+                publish_future.result()
+            except Exception:
+                LOGGER.exception(f'failed to publish wordcloud for {minutes_id}')
+                continue
+            id2hash[minutes_id] = {'hash': id2render_future[minutes_id][1], 'published': True}
+
+
 def main():
-    minutes_list = gql_client.get_all_minutes(fields=['id', 'name', 'start_date_time', 'ndl_min_id'])
+    snapshot = GraphQLSnapshot(gql_client, run_id=args.run_id)
+    minutes_list = snapshot.get_all_minutes(fields=['id', 'name', 'start_date_time', 'ndl_min_id'])
     LOGGER.info(f'loaded {len(minutes_list)} minutes from GraphQL')
     minutes_list = list(filter(lambda x: is_target_minutes(x), minutes_list))
     LOGGER.info(f'filtered {len(minutes_list)} target minutes')
-    all_data = load_all_data(args.file)
+    if args.file.endswith('.db'):
+        all_data = load_tfidf_store(args.file)
+    else:
+        all_data = load_all_data(args.file)
     LOGGER.info(f'loaded {len(all_data)} data from {args.file}')
+    hash_fp = str(Path(args.file).with_name('tfidf_hash.json'))
+    id2hash = load_all_data(hash_fp)
 
-    for minutes in tqdm(minutes_list):
-        try:
-            term2stats = fetch_term_statistics(minutes.id)
-        except ElasticsearchException:
-            LOGGER.exception(f'failed to load term statistics from Elasticsearch for {minutes.id}')
-            continue
-        if not term2stats:
-            LOGGER.warning(f'term statistic is empty for {minutes.id}')
-            continue
-        all_data[minutes.id] = term2stats
-        process(minutes.id, term2stats)
+    if args.parallel:
+        process_parallel(minutes_list, all_data, id2hash)
+    else:
+        for i in tqdm(range(0, len(minutes_list), args.batch_size)):
+            batch = minutes_list[i:i + args.batch_size]
+            id2term2stats = load_term_statistics([minutes.id for minutes in batch])
+            for minutes in batch:
+                term2stats = id2term2stats[minutes.id]
+                if term2stats is None:
+                    continue
+                all_data[minutes.id] = term2stats
+                tfidf_hash = calc_tfidf_hash(term2stats)
+                if is_unchanged(minutes.id, tfidf_hash, id2hash):
+                    LOGGER.debug(f'wordcloud is unchanged for {minutes.id}')
+                    continue
+                process(minutes.id, term2stats)
+                id2hash[minutes.id] = {'hash': tfidf_hash, 'published': args.publish}
     LOGGER.info(f'processed {len(minutes_list)} minutes')
-    save_all_data(all_data, args.file)
-    LOGGER.info(f'saved {len(all_data)} data to {args.file}')
-    post_all_date(args.file)
-    LOGGER.info(f'posted {args.file} to wordcloud server')
+    if isinstance(all_data, TfidfStore):
+        all_data.commit()
+        LOGGER.info(f'upserted {len(all_data.updated_ids)} data to {args.file}')
+        # wordcloud server only loads JSON, so the store is exported to JSON when any minutes is updated
+        json_fp = str(Path(args.file).with_suffix('.json'))
+        if all_data.updated_ids:
+            save_all_data(dict(all_data.items()), json_fp)
+            LOGGER.info(f'exported {len(all_data)} data to {json_fp}')
+        else:
+            json_fp = None
+            LOGGER.info(f'skipped exporting {args.file} since no data is updated')
+    else:
+        json_fp = args.file
+        save_all_data(all_data, json_fp)
+        LOGGER.info(f'saved {len(all_data)} data to {json_fp}')
+    save_all_data(id2hash, hash_fp)
+    LOGGER.info(f'saved {len(id2hash)} hashes to {hash_fp}')
+    if json_fp:
+        post_all_date(json_fp)
+        LOGGER.info(f'posted {json_fp} to wordcloud server')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Minutesのワードクラウドを生成する')
     parser.add_argument('-s', '--start_date', help='開始日（例: 2020-01-01）', type=date_type, required=True)
     parser.add_argument('-e', '--end_date', help='終了日（例: 2020-01-02）', type=date_type, required=True)
-    parser.add_argument('-f', '--file', help='ワードクラウドサーバー用に全てのtfidfを保存するjsonファイル。',
+    parser.add_argument('-f', '--file', help='ワードクラウドサーバー用に全てのtfidfを保存するjsonファイル。'
+                                             '拡張子が.dbの場合はSQLiteファイルに保存し、更新があれば同名のjsonファイルに書き出す。',
                         default='./wordcloud/minutes/tfidf.json')
     parser.add_argument('-p', '--publish', help='画像をS3にアップロードする', action='store_true')
+    parser.add_argument('-o', '--overwrite', help='tfidfが変化していなくても画像を再生成する', action='store_true')
+    parser.add_argument('--parallel', help='ワードクラウドの描画をCPUコア数のプロセスで並列に実行する', action='store_true')
+    parser.add_argument('-n', '--batch_size', help='Elasticsearchから一度に取得するMinutesの数', type=int, default=50)
+    parser.add_argument('--io_workers', help='並列実行時にElasticsearchとS3にアクセスするスレッド数', type=int, default=8)
+    parser.add_argument('--run_id', help='同じIDで保存されたGraphQLのスナップショットを再利用する（cron.pyが指定する）')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
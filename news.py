@@ -1,15 +1,19 @@
 import argparse
+import hashlib
 import json
 import logging
+import sqlite3
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 
-import requests
 from tqdm import tqdm
 
 from politylink.elasticsearch.client import ElasticsearchClient
 from politylink.graphql.client import GraphQLClient
 from politylink.graphql.schema import News
-from utils import date_type
+from utils import date_type, RateLimiter, HttpClient
 
 LOGGER = logging.getLogger(__name__)
 MINUTES_HANDLER = 'https://sharpspock.herokuapp.com/minutes'
@@ -17,32 +21,183 @@ BILLS_HANDLER = 'https://sharpspock.herokuapp.com/bills'
 DIET_HANDLER = 'https://sharpspock.herokuapp.com/process'
 
 
-def call_api(news, news_text, handler):
-    text = ' '.join([news_text.title, news_text.body])
-    date = news.published_at
-    date_str = '{}/{}/{} {}:{}'.format(date.year, date.month, date.day, date.hour, date.minute)
-    json_data = json.dumps({"text": text, "date": date_str}, ensure_ascii=False)
-    res = requests.post(handler,
-                        data=json_data.encode("utf-8"),
-                        headers={'Content-Type': 'application/json'})
-    return res.json()
+class ApiClient:
+    """
+    client of classifier APIs, which shares HTTP connections and rate limit of each handler
+    responses are not cached since they depend on minutes and bills on the server side as well as the payload
+    """
 
+    def __init__(self, http_client, rate_limit=0):
+        self.http_client = http_client
+        self.handler2limiter = dict()
+        if rate_limit > 0:
+            for handler in [MINUTES_HANDLER, BILLS_HANDLER, DIET_HANDLER]:
+                self.handler2limiter[handler] = RateLimiter(1 / rate_limit)
 
-def fetch_matched_minutes(news, news_text):
-    res = call_api(news, news_text, MINUTES_HANDLER)
+    def call(self, news, news_text, handler):
+        text = ' '.join([news_text.title, news_text.body])
+        date = news.published_at
+        date_str = '{}/{}/{} {}:{}'.format(date.year, date.month, date.day, date.hour, date.minute)
+        json_data = json.dumps({"text": text, "date": date_str}, ensure_ascii=False)
+
+        res = self.http_client.post(handler,
+                                    data=json_data.encode("utf-8"),
+                                    headers={'Content-Type': 'application/json'},
+                                    limiter=self.handler2limiter.get(handler),
+                                    stats_key=handler)
+        return res.json()
+
+
+def fetch_matched_minutes(api_client, news, news_text):
+    res = api_client.call(news, news_text, MINUTES_HANDLER)
     return res['minutes']
 
 
-def fetch_matched_bills(news, news_text):
-    res = call_api(news, news_text, BILLS_HANDLER)
+def fetch_matched_bills(api_client, news, news_text):
+    res = api_client.call(news, news_text, BILLS_HANDLER)
     return res['bills']
 
 
-def fetch_is_timeline(news, news_text):
-    res = call_api(news, news_text, DIET_HANDLER)
+def fetch_is_timeline(api_client, news, news_text):
+    res = api_client.call(news, news_text, DIET_HANDLER)
     return res['diet_flag'] > 0
 
 
+class GraphQLBuffer:
+    """
+    accumulate GraphQL mutations of multiple news and flush them at once
+    """
+
+    def __init__(self, gql_client):
+        self.gql_client = gql_client
+        self.from_ids = []
+        self.to_ids = []
+        self.news_list = []
+        self.id2result = dict()
+
+    def __len__(self):
+        return len(self.from_ids) + len(self.news_list)
+
+    def add_links(self, news_id, to_ids):
+        self.from_ids += [news_id] * len(to_ids)
+        self.to_ids += to_ids
+
+    def add_timeline(self, news_id):
+        # need to create new instance to avoid neo4j datetime error
+        updated_news = News(None)
+        updated_news.id = news_id
+        updated_news.is_timeline = True
+        self.news_list.append(updated_news)
+
+    def add_result(self, news_id, task2hash):
+        """
+        register the result hashes to be recorded in NewsLedger after flush
+        """
+
+        self.id2result[news_id] = task2hash
+
+    def flush(self):
+        if self.from_ids:
+            self.gql_client.bulk_link(self.from_ids, self.to_ids)
+        if self.news_list:
+            self.gql_client.bulk_merge(self.news_list)
+        LOGGER.debug(f'flushed {len(self)} mutations for {len(self.id2result)} news')
+        self.clear()
+
+    def clear(self):
+        self.from_ids, self.to_ids, self.news_list = [], [], []
+        self.id2result = dict()
+
+
+class NewsLedger:
+    """
+    SQLite-backed record of news whose results were successfully written to GraphQL
+    each task column holds the hash of the written result, or NULL if the task has not succeeded yet
+    """
+
+    TASKS = ['minutes', 'bills', 'timeline']
+
+    def __init__(self, db_fp):
+        Path(db_fp).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(db_fp)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS news '
+                          '(id TEXT PRIMARY KEY, minutes TEXT, bills TEXT, timeline TEXT, updated_at REAL)')
+
+    def get_done_ids(self, tasks):
+        condition = ' AND '.join(f'{task} IS NOT NULL' for task in tasks) or 'TRUE'
+        return set(row[0] for row in self.conn.execute(f'SELECT id FROM news WHERE {condition}'))
+
+    def get_hashes(self):
+        """
+        return result hashes of each news as {news_id: {task: hash}}
+        """
+
+        cursor = self.conn.execute(f'SELECT id, {", ".join(self.TASKS)} FROM news')
+        return {row[0]: dict(zip(self.TASKS, row[1:])) for row in cursor}
+
+    def record(self, id2result):
+        now = time.time()
+        for news_id, task2hash in id2result.items():
+            self.conn.execute('INSERT OR IGNORE INTO news (id) VALUES (?)', (news_id,))
+            for task, result_hash in task2hash.items():
+                assert task in self.TASKS
+                self.conn.execute(f'UPDATE news SET {task} = ?, updated_at = ? WHERE id = ?',
+                                  (result_hash, now, news_id))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def calc_result_hash(result):
+    return hashlib.md5(json.dumps(result, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_target_tasks():
+    tasks = []
+    if not args.skip_minutes:
+        tasks.append('minutes')
+    if not args.skip_bill:
+        tasks.append('bills')
+    if not args.skip_timeline:
+        tasks.append('timeline')
+    return tasks
+
+
+def process_news(news, es_client, api_client, api_executor):
+    """
+    call classifier APIs for a news in parallel
+    :return: tuple of (list of minutes ids, list of bill ids, is_timeline)
+    """
+
+    LOGGER.debug(f'process {news.id}')
+    news_text = es_client.get(news.id)
+    minutes_future = bills_future = timeline_future = None
+    if not args.skip_minutes:
+        minutes_future = api_executor.submit(fetch_matched_minutes, api_client, news, news_text)
+    if not args.skip_bill:
+        bills_future = api_executor.submit(fetch_matched_bills, api_client, news, news_text)
+    if not args.skip_timeline:
+        timeline_future = api_executor.submit(fetch_is_timeline, api_client, news, news_text)
+
+    minutes_ids = [minutes['id'] for minutes in minutes_future.result()] if minutes_future else []
+    bill_ids = [bill['id'] for bill in bills_future.result()] if bills_future else []
+    is_timeline = timeline_future.result() if timeline_future else False
+    return minutes_ids, bill_ids, is_timeline
+
+
+def flush_buffer(gql_buffer, ledger, stats):
+    id2result = gql_buffer.id2result
+    try:
+        gql_buffer.flush()
+    except Exception:
+        LOGGER.exception(f'failed to write results of {len(id2result)} news to GraphQL')
+        stats['fail'] += len(id2result)
+        gql_buffer.clear()
+        return
+    ledger.record(id2result)
+
+
 def main():
     gql_client = GraphQLClient()
     es_client = ElasticsearchClient()
@@ -55,43 +210,65 @@ def main():
         news_list = list(filter(lambda x: x.is_timeline, news_list))
         LOGGER.info(f'filtered {len(news_list)} timeline news')
 
+    tasks = get_target_tasks()
+    ledger = NewsLedger(args.ledger)
+    id2prev = ledger.get_hashes()
+    # --check_timeline is a recomputation by definition, so it also ignores the ledger
+    if not (args.force or args.check_timeline):
+        done_ids = ledger.get_done_ids(tasks)
+        news_list = list(filter(lambda x: x.id not in done_ids, news_list))
+        LOGGER.info(f'filtered {len(news_list)} new or failed news')
+
+    # all handlers share the same host, so the pool needs a connection for every concurrent API call
+    http_client = HttpClient(timeout=args.timeout, max_retries=args.max_retries, pool_size=args.workers * 3)
+    api_client = ApiClient(http_client, args.rate_limit)
+
     stats = defaultdict(int)
-    for news in tqdm(news_list):
-        LOGGER.info(f'process {news.id}')
-        stats['process'] += 1
-        try:
-            news_text = es_client.get(news.id)
-            if not args.skip_minutes:
-                LOGGER.debug(f'check Minutes for {news.id}')
-                minutes_list = fetch_matched_minutes(news, news_text)
-                if minutes_list:
-                    gql_client.bulk_link([news.id] * len(minutes_list), map(lambda x: x['id'], minutes_list))
-                    LOGGER.info(f'linked {len(minutes_list)} minutes for {news.id}')
-            if not args.skip_bill:
-                LOGGER.debug(f'check Bill for {news.id}')
-                bill_list = fetch_matched_bills(news, news_text)
-                if bill_list:
-                    gql_client.bulk_link([news.id] * len(bill_list), map(lambda x: x['id'], bill_list))
-                    LOGGER.info(f'linked {len(bill_list)} bills for {news.id}')
-            if not args.skip_timeline:
-                LOGGER.debug(f'check Timeline for {news.id}')
-                is_timeline = fetch_is_timeline(news, news_text)
-                if is_timeline:
-                    # need to create new instance to avoid neo4j datetime error
-                    updated_news = News(None)
-                    updated_news.id = news.id
-                    updated_news.is_timeline = is_timeline
-                    gql_client.merge(updated_news)
-                    LOGGER.info(f'linked {news.id} to timeline')
-        except Exception as e:
-            stats['fail'] += 1
-            if isinstance(e, json.decoder.JSONDecodeError):
-                LOGGER.warning(f'failed to parse API response for {news.id}')
-            else:
-                LOGGER.exception(f'failed to process {news.id}')
-    LOGGER.info('processed {} news ({} success, {} fail)'.format(
-        stats['process'], stats['process'] - stats['fail'], stats['fail']
+    gql_buffer = GraphQLBuffer(gql_client)
+    # use separate executors for news and API calls to avoid deadlock of nested submission
+    with ThreadPoolExecutor(max_workers=args.workers) as news_executor, \
+            ThreadPoolExecutor(max_workers=args.workers * 3) as api_executor:
+        future2news = {news_executor.submit(process_news, news, es_client, api_client, api_executor): news
+                       for news in news_list}
+        for future in tqdm(as_completed(future2news), total=len(future2news)):
+            news = future2news[future]
+            stats['process'] += 1
+            try:
+                minutes_ids, bill_ids, is_timeline = future.result()
+            except Exception as e:
+                stats['fail'] += 1
+                if isinstance(e, json.decoder.JSONDecodeError):
+                    LOGGER.warning(f'failed to parse API response for {news.id}')
+                else:
+                    LOGGER.exception(f'failed to process {news.id}')
+                continue
+
+            task2result = {'minutes': sorted(minutes_ids), 'bills': sorted(bill_ids), 'timeline': is_timeline}
+            task2hash = {task: calc_result_hash(task2result[task]) for task in tasks}
+            # skip mutations identical to the ones already written
+            prev_task2hash = id2prev.get(news.id, dict())
+            changed_tasks = [task for task in tasks if prev_task2hash.get(task) != task2hash[task]]
+            if not changed_tasks:
+                stats['unchanged'] += 1
+            if minutes_ids and 'minutes' in changed_tasks:
+                gql_buffer.add_links(news.id, minutes_ids)
+                LOGGER.info(f'found {len(minutes_ids)} minutes for {news.id}')
+            if bill_ids and 'bills' in changed_tasks:
+                gql_buffer.add_links(news.id, bill_ids)
+                LOGGER.info(f'found {len(bill_ids)} bills for {news.id}')
+            if is_timeline and 'timeline' in changed_tasks:
+                gql_buffer.add_timeline(news.id)
+                LOGGER.info(f'found {news.id} for timeline')
+            gql_buffer.add_result(news.id, task2hash)
+            if len(gql_buffer) >= args.batch_size:
+                flush_buffer(gql_buffer, ledger, stats)
+    flush_buffer(gql_buffer, ledger, stats)
+    ledger.close()
+
+    LOGGER.info('processed {} news ({} success, {} fail, {} unchanged)'.format(
+        stats['process'], stats['process'] - stats['fail'], stats['fail'], stats['unchanged']
     ))
+    http_client.log_stats(LOGGER)
 
 
 if __name__ == '__main__':
@@ -102,6 +279,14 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--skip_minutes', help='Minutesを関連付けない', action='store_true')
     parser.add_argument('-t', '--skip_timeline', help='Timelineを関連付けない', action='store_true')
     parser.add_argument('--check_timeline', help='timelineフラグがたっているNewsのみを再計算する', action='store_true')
+    parser.add_argument('-w', '--workers', help='同時に処理するNewsの数', type=int, default=4)
+    parser.add_argument('-r', '--rate_limit', help='各APIへの1秒あたりの最大リクエスト数（0以下で無制限）',
+                        type=float, default=5)
+    parser.add_argument('--timeout', help='APIのタイムアウト（秒）', type=float, default=30)
+    parser.add_argument('--max_retries', help='APIの5xxエラーやタイムアウト時の最大リトライ回数', type=int, default=3)
+    parser.add_argument('--ledger', help='処理済みのNewsを記録するSQLiteファイル', default='./state/news_ledger.db')
+    parser.add_argument('-f', '--force', help='処理済みのNewsも再計算する', action='store_true')
+    parser.add_argument('-n', '--batch_size', help='GraphQLにまとめて書き込むmutationの数', type=int, default=100)
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
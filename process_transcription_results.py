@@ -1,10 +1,15 @@
 import argparse
-import dataclasses
+import functools
 import glob
 import json
 import logging
 import os
 import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import List
 
 import boto3
@@ -16,22 +21,89 @@ from politylink.graphql.schema import Url, Minutes
 from politylink.idgen import idgen
 
 LOGGER = logging.getLogger(__name__)
+PUNCTUATION_SUFFIXES = ['ました', 'します', 'きます', 'います', 'ります']
+# suffixes neither contain nor overlap each other, so one pass is the same as applying each suffix in order
+PUNCTUATION_PATTERN = re.compile('({})。?'.format('|'.join(PUNCTUATION_SUFFIXES)))
+PENDING_LINKS_FP = './voice/pending_links.json'
 
-gql_client = GraphQLClient()
-s3_client = boto3.client('s3')
+# clients are created in each worker process by init_worker, since they are not safe to share across fork
+gql_client = None
+s3_client = None
 
 
-@dataclasses.dataclass
 class VoiceSegment:
-    transcript: str
-    start_time: float
-    end_time: float
-    is_first: bool = False
+    # __slots__ since long sessions have tens of thousands of segments
+    __slots__ = ['transcript', 'start_time', 'end_time', 'is_first']
 
+    def __init__(self, transcript: str, start_time: float, end_time: float, is_first: bool = False):
+        self.transcript = transcript
+        self.start_time = start_time
+        self.end_time = end_time
+        self.is_first = is_first
 
-def load_voice_segments(json_fp):
+    def __eq__(self, other):
+        return isinstance(other, VoiceSegment) and all(
+            getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+
+    def __repr__(self):
+        return 'VoiceSegment({})'.format(', '.join(f'{attr}={getattr(self, attr)!r}' for attr in self.__slots__))
+
+
+def iter_json_array(f, key, chunk_size=1 << 20):
+    """
+    yield elements of the first JSON array with the given key one by one
+    only the current element is decoded, so the whole file is never materialized as Python objects
+    """
+
+    decoder = json.JSONDecoder()
+    separator_pattern = re.compile(r'[\s,]*')
+    pattern = f'"{key}":'
+    buffer = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+        idx = buffer.find(pattern)
+        if idx >= 0:
+            buffer = buffer[idx + len(pattern):]
+            break
+        buffer = buffer[-len(pattern):]
+
+    pos, is_opened = 0, False
+    while True:
+        pos = separator_pattern.match(buffer, pos).end()
+        if pos == len(buffer):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError(f'unexpected end of JSON array: {key}')
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        if not is_opened:
+            if buffer[pos] != '[':
+                raise ValueError(f'{key} is not a JSON array')
+            pos, is_opened = pos + 1, True
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            element, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the element continues in the next chunk
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield element
+        if pos > chunk_size:
+            buffer, pos = buffer[pos:], 0
+
+
+def load_voice_segments(json_fp, stream=True):
     """
     load voice segments from GCP transcription result file (JSON)
+    results are parsed one by one if stream is True, otherwise the whole file is loaded by json.load
     ref: fetch_transcription_results.py
     """
 
@@ -39,20 +111,133 @@ def load_voice_segments(json_fp):
         return float(time_str[:-1])  # remove last "s"
 
     with open(json_fp, 'r') as f:
-        data = json.load(f)
-
-    segments = []
-    for result in data['response']['results'][:-1]:
-        result = result['alternatives'][0]
-        segment = VoiceSegment(
-            result['transcript'],
-            parse_time_str(result['words'][0]['startTime']),
-            parse_time_str(result['words'][-1]['endTime'])
-        )
-        segments.append(segment)
+        results = iter_json_array(f, 'results') if stream else iter(json.load(f)['response']['results'])
+        segments = []
+        # the last result is skipped, so each result is converted after the next one is read
+        prev_result = next(results, None)
+        for result in results:
+            prev_result = prev_result['alternatives'][0]
+            segment = VoiceSegment(
+                prev_result['transcript'],
+                parse_time_str(prev_result['words'][0]['startTime']),
+                parse_time_str(prev_result['words'][-1]['endTime'])
+            )
+            segments.append(segment)
+            prev_result = result
     return segments
 
 
+def build_synthetic_result(json_fp, hours):
+    """
+    write a synthetic GCP transcription result file (JSON) for benchmark
+    each result has 10 seconds of transcript with 30 words like a long session
+    """
+
+    transcripts = [
+        'ご指摘の点については検討してまいります',
+        'ただいまから委員会を開会いたします。',
+        '法案の趣旨について説明をお願いしました',
+        'この点は大変重要であると考えております大臣に伺います',
+        '以上です'
+    ]
+    results = []
+    for i in range(int(hours * 360)):
+        words = [{
+            'startTime': f'{i * 10 + j / 3:.3f}s',
+            'endTime': f'{i * 10 + (j + 1) / 3:.3f}s',
+            'word': '答弁',
+            'speakerTag': j % 2 + 1
+        } for j in range(30)]
+        results.append({
+            'alternatives': [{
+                'transcript': transcripts[i % len(transcripts)] * 3,
+                'confidence': 0.9,
+                'words': words
+            }],
+            'languageCode': 'ja-jp'
+        })
+    results.append({'alternatives': [{}], 'languageCode': 'ja-jp'})
+    data = {
+        'name': '0',
+        'metadata': {
+            'progressPercent': 100,
+            'uri': 'gs://politylink-speech-mu/voice/benchmark.mp3',
+            'job_id': 'benchmark'
+        },
+        'done': True,
+        'response': {'results': results}
+    }
+    with open(json_fp, 'w') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def benchmark(hours):
+    """
+    compare time and peak memory of json.load and streaming to load voice segments of a synthetic result
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_fp = os.path.join(tmp_dir, 'benchmark.json')
+        build_synthetic_result(json_fp, hours)
+        LOGGER.info(f'built synthetic result of {hours} hours ({os.path.getsize(json_fp) / 2 ** 20:.1f}MB)')
+
+        mode2segments = dict()
+        for mode, stream in [('json.load', False), ('stream', True)]:
+            start_time = time.perf_counter()
+            mode2segments[mode] = load_voice_segments(json_fp, stream)
+            elapsed = time.perf_counter() - start_time
+            # measure memory in another run since tracemalloc slows down parsing
+            tracemalloc.start()
+            load_voice_segments(json_fp, stream)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            LOGGER.info(f'{mode}: {len(mode2segments[mode])} segments, {elapsed:.2f}s, '
+                        f'{peak_memory / 2 ** 20:.1f}MB peak memory')
+        assert mode2segments['json.load'] == mode2segments['stream'], 'voice segments are different'
+    benchmark_transcripts(mode2segments['stream'])
+
+
+def benchmark_transcripts(voice_segments, num_repeats=10):
+    """
+    compare time to build transcripts with the previous implementation and check that outputs are identical
+    """
+
+    def insert_punctuation_legacy(text):
+        for suffix in PUNCTUATION_SUFFIXES:
+            pattern = r'{}(。)?'.format(suffix)
+            repl = '{}。'.format(suffix)
+            text = re.sub(pattern, repl, text)
+        if text[-1] != '。':
+            text += '。'
+        return text
+
+    def build_transcripts_legacy(segments):
+        buffer = ''
+        transcripts = []
+        for segment in segments:
+            if segment.is_first and buffer:
+                transcripts.append(buffer)
+                buffer = ''
+            buffer += insert_punctuation_legacy(segment.transcript)
+        if buffer:
+            transcripts.append(buffer)
+        return transcripts
+
+    for i, segment in enumerate(voice_segments):
+        segment.is_first = i % 7 == 0
+    mode2transcripts = dict()
+    for mode, func in [('legacy', build_transcripts_legacy), ('current', build_transcripts)]:
+        start_time = time.perf_counter()
+        for _ in range(num_repeats):
+            mode2transcripts[mode] = func(voice_segments)
+        elapsed = (time.perf_counter() - start_time) / num_repeats
+        LOGGER.info(f'build transcripts ({mode}): {elapsed * 1000:.1f}ms')
+    legacy_bytes = '\n'.join(mode2transcripts['legacy']).encode('utf-8')
+    current_bytes = '\n'.join(mode2transcripts['current']).encode('utf-8')
+    assert mode2transcripts['legacy'] == mode2transcripts['current'] and legacy_bytes == current_bytes, \
+        'transcripts are different'
+
+
 def load_video_switch_secs(diff_fp, thresh_diff):
     """
     load video camera switch seconds from video diff file (CSV)
@@ -104,29 +289,42 @@ def set_is_first_by_video(segments: List[VoiceSegment], switch_secs: List[int]):
 
 
 def insert_punctuation(text):
-    suffixes = ['ました', 'します', 'きます', 'います', 'ります']
-    for suffix in suffixes:
-        pattern = r'{}(。)?'.format(suffix)
-        repl = '{}。'.format(suffix)
-        text = re.sub(pattern, repl, text)
+    text = PUNCTUATION_PATTERN.sub(r'\1。', text)
     if text[-1] != '。':
         text += '。'
     return text
 
 
-def build_html(voice_segments: List[VoiceSegment], minutes: Minutes):
-    buffer = ''
+@functools.lru_cache()
+def get_template():
+    """
+    compile the template only once per process
+    """
+
+    return Environment(loader=FileSystemLoader('./data', encoding='utf8')) \
+        .get_template('transcription_template.html')
+
+
+def build_transcripts(voice_segments: List[VoiceSegment]):
+    """
+    join transcripts of voice segments into paragraphs, which start from segments with is_first flag
+    """
+
+    buffer = []
     transcripts = []
     for segment in voice_segments:
         if segment.is_first and buffer:
-            transcripts.append(buffer)
-            buffer = ''
-        buffer += insert_punctuation(segment.transcript)
+            transcripts.append(''.join(buffer))
+            buffer = []
+        buffer.append(insert_punctuation(segment.transcript))
     if buffer:
-        transcripts.append(buffer)
+        transcripts.append(''.join(buffer))
+    return transcripts
 
-    template = Environment(loader=FileSystemLoader('./data', encoding='utf8')) \
-        .get_template('transcription_template.html')
+
+def build_html(voice_segments: List[VoiceSegment], minutes: Minutes):
+    transcripts = build_transcripts(voice_segments)
+    template = get_template()
     date = minutes.start_date_time
     date_str = f'{date.year:02}-{date.month:02}-{date.day:02}'
     html = template.render({
@@ -148,7 +346,35 @@ def build_gql_url(s3_url):
     return url
 
 
+def init_worker():
+    global gql_client, s3_client
+    gql_client = GraphQLClient()
+    s3_client = boto3.client('s3')
+
+
+def load_pending_links():
+    """
+    return (URL of the uploaded HTML, minutes id) pairs which were published but not linked yet
+    they are persisted because HTML of published jobs exists locally and the jobs are not processed again
+    """
+
+    if not os.path.exists(PENDING_LINKS_FP):
+        return list()
+    with open(PENDING_LINKS_FP, 'r') as f:
+        return list(map(tuple, json.load(f)))
+
+
+def save_pending_links(url_links):
+    with open(PENDING_LINKS_FP, 'w') as f:
+        json.dump(url_links, f, indent=2)
+
+
 def process(job_id, time_thresh, diff_thresh, publish):
+    """
+    build transcription HTML of the job and upload it to S3 if publish is True
+    :return: tuple of (URL of the uploaded HTML, minutes id), or None if not published
+    """
+
     LOGGER.info(f'process {job_id}')
     minutes = gql_client.get(f'Minutes:{job_id}')
     json_fp = f'./voice/{job_id}.json'
@@ -176,10 +402,44 @@ def process(job_id, time_thresh, diff_thresh, publish):
     if publish:
         s3_client.upload_file(json_fp, 'politylink-text', s3_json_fp, ExtraArgs={"ContentType": "application/json"})
         s3_client.upload_file(html_fp, 'politylink-text', s3_html_fp, ExtraArgs={"ContentType": "text/html"})
-        gql_url = build_gql_url(s3_html_url)
-        gql_client.merge(gql_url)
-        gql_client.link(gql_url.id, minutes.id)
         LOGGER.info(f'published HTML to S3: {s3_html_url}')
+        return s3_html_url, minutes.id
+    return None
+
+
+def process_all(ids, time_thresh, diff_thresh, publish, num_workers):
+    """
+    process jobs in a process pool and write Urls of all published HTML to GraphQL at once
+    links are saved in PENDING_LINKS_FP as soon as each job is published, and retried in the next run if linking fails
+    """
+
+    get_template()  # compile before fork so that workers can reuse it
+    url_links = load_pending_links()
+    if url_links:
+        LOGGER.info(f'found {len(url_links)} pending links from the previous run')
+    num_processed = 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker) as executor:
+        future2id = {executor.submit(process, id_, time_thresh, diff_thresh, publish): id_ for id_ in ids}
+        for future in as_completed(future2id):
+            try:
+                result = future.result()
+            except Exception:
+                LOGGER.exception(f'failed to process {future2id[future]}')
+                continue
+            num_processed += 1
+            if result and result not in url_links:
+                url_links.append(result)
+                save_pending_links(url_links)
+    LOGGER.info(f'processed {num_processed} of {len(ids)} ids')
+
+    if url_links:
+        s3_html_urls, minutes_ids = zip(*url_links)
+        gql_urls = [build_gql_url(s3_html_url) for s3_html_url in s3_html_urls]
+        gql_client = GraphQLClient()
+        gql_client.bulk_merge(gql_urls)
+        gql_client.bulk_link([gql_url.id for gql_url in gql_urls], minutes_ids)
+        save_pending_links(list())
+        LOGGER.info(f'linked {len(gql_urls)} Urls to minutes')
 
 
 if __name__ == '__main__':
@@ -188,24 +448,27 @@ if __name__ == '__main__':
     parser.add_argument('-tt', '--time_thresh', help='この閾値（sec）より長く音声が途切れたら改行する', default=3)
     parser.add_argument('-dt', '--diff_thresh', help='この閾値（rate）より大きく動画が変化したら改行する', default=0.5)
     parser.add_argument('-p', '--publish', help='S3にHTMLをアップロードする', action='store_true')
+    parser.add_argument('-w', '--workers', help='並列に処理するプロセス数', type=int, default=os.cpu_count())
+    parser.add_argument('--benchmark', help='指定した時間（hour）の合成データでJSONの読み込みを比較する', type=float)
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     logging.getLogger('sgqlc').setLevel(logging.INFO)
 
+    if args.benchmark:
+        benchmark(args.benchmark)
+        sys.exit()
+
     if args.id:
         # process specified ID
         ids = [args.id]
     else:
-        # process all IDs without HTML
-        json_ids = set(map(lambda fp: fp.split('/')[-1].split('.')[0], glob.glob('./voice/*.json')))
+        # process all IDs without HTML (operations.json is the index of fetch_transcription_results.py)
+        json_ids = set(map(lambda fp: fp.split('/')[-1].split('.')[0], glob.glob('./voice/*.json'))) - \
+                   {'operations', 'pending_links'}
         html_ids = set(map(lambda fp: fp.split('/')[-1].split('.')[0], glob.glob('./voice/*.html')))
         ids = list(json_ids - html_ids)
 
     LOGGER.info(f'found {len(ids)} ids to process: {ids}')
-    for id_ in ids:
-        try:
-            process(id_, args.time_thresh, args.diff_thresh, args.publish)
-        except Exception:
-            LOGGER.exception(f'failed to process {id_}')
+    process_all(ids, args.time_thresh, args.diff_thresh, args.publish, args.workers)
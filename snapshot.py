@@ -0,0 +1,83 @@
+import gzip
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from politylink.graphql.client import GraphQLClient
+from politylink.graphql.schema import Bill, Minutes, Member
+
+LOGGER = logging.getLogger(__name__)
+CLASS_NAME2CLS = {
+    'bill': Bill,
+    'minutes': Minutes,
+    'member': Member
+}
+
+
+class GraphQLSnapshot:
+    """
+    on-disk snapshot of all GraphQL objects of each type, shared among scripts in one cron run
+    the snapshot is reused if it was saved with the same run_id and contains all requested fields
+    otherwise objects are fetched from GraphQL and the snapshot is overwritten
+    without run_id (e.g. manual runs), objects are always fetched from GraphQL
+    """
+
+    def __init__(self, gql_client: GraphQLClient, snapshot_dir='./snapshot', run_id=None):
+        self.gql_client = gql_client
+        self.snapshot_dir = Path(snapshot_dir)
+        self.run_id = run_id
+
+    def get_all_bills(self, fields):
+        return self.get_all_objects('bill', fields)
+
+    def get_all_minutes(self, fields):
+        return self.get_all_objects('minutes', fields)
+
+    def get_all_members(self, fields):
+        return self.get_all_objects('member', fields)
+
+    def get_all_objects(self, class_name, fields):
+        snapshot_fp = self.snapshot_dir / f'{class_name}.json.gz'
+        maybe_snapshot = self.load(snapshot_fp) if self.run_id else None
+        if maybe_snapshot and maybe_snapshot.get('run_id') == self.run_id:
+            if set(fields) <= set(maybe_snapshot['fields']):
+                cls = CLASS_NAME2CLS[class_name]
+                objects = [cls(json_data) for json_data in maybe_snapshot['data']]
+                LOGGER.info(f'loaded {len(objects)} {class_name} from {snapshot_fp}')
+                return objects
+            # fetch the union so that both the previous and current scripts can reuse the new snapshot
+            fields = sorted(set(fields) | set(maybe_snapshot['fields']))
+
+        objects = self.gql_client.get_all_objects(class_name, fields)
+        if self.run_id:
+            self.save(snapshot_fp, self.run_id, fields, objects)
+            LOGGER.info(f'saved {len(objects)} {class_name} to {snapshot_fp}')
+        return objects
+
+    @staticmethod
+    def load(snapshot_fp):
+        if not snapshot_fp.exists():
+            return None
+        try:
+            with gzip.open(snapshot_fp, 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            LOGGER.warning(f'failed to load {snapshot_fp}')
+            return None
+
+    @staticmethod
+    def save(snapshot_fp, run_id, fields, objects):
+        snapshot = {
+            'run_id': run_id,
+            'created_at': time.time(),
+            'fields': list(fields),
+            'data': [obj.__json_data__ for obj in objects]
+        }
+        snapshot_fp.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file and rename it, since other scripts may read the snapshot concurrently
+        tmp_fp = snapshot_fp.with_name(f'{snapshot_fp.name}.{os.getpid()}.tmp')
+        with gzip.open(tmp_fp, 'wt', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_fp, snapshot_fp)
@@ -1,8 +1,15 @@
 import argparse
-import glob
+import fcntl
 import logging
+import os
 import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
 
 import requests
 
@@ -31,39 +38,226 @@ def get_m3u8_url(video_url):
         raise ValueError('m3u8 url not found')
 
 
+class JobQueue:
+    """
+    thread-safe persistent queue of transcription jobs backed by SQLite
+    each job goes queued -> downloading -> submitted -> done, and failed jobs are queued again with backoff
+    """
+
+    QUEUED = 'queued'
+    DOWNLOADING = 'downloading'
+    SUBMITTED = 'submitted'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [QUEUED, DOWNLOADING, SUBMITTED, DONE, FAILED]
+
+    def __init__(self, db_fp):
+        Path(db_fp).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_fp, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS job (id TEXT PRIMARY KEY, m3u8_url TEXT, status TEXT, '
+                          'attempts INTEGER, next_run_at REAL, error TEXT, updated_at REAL)')
+        self.lock_file = open(f'{db_fp}.lock', 'w')
+
+    def try_lock(self):
+        """
+        take an exclusive lock on the queue so that only one run processes jobs at a time
+        the lock is released by close() or when the process exits, even if it is killed
+        :return: False if another run holds the lock
+        """
+
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def __contains__(self, job_id):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM job WHERE id = ?', (job_id,)).fetchone() is not None
+
+    def add(self, job_id, m3u8_url):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO job VALUES (?, ?, ?, 0, ?, NULL, ?)',
+                              (job_id, m3u8_url, self.QUEUED, now, now))
+            self.conn.commit()
+
+    def reset_interrupted(self):
+        """
+        queue jobs again which were downloading when the previous run was killed
+        must be called while holding the lock, otherwise jobs of a running process would be reset
+        """
+
+        with self.lock:
+            cursor = self.conn.execute('UPDATE job SET status = ?, updated_at = ? WHERE status = ?',
+                                       (self.QUEUED, time.time(), self.DOWNLOADING))
+            self.conn.commit()
+        return cursor.rowcount
+
+    def pop(self):
+        """
+        mark the next runnable job as downloading and return (job_id, m3u8_url), or None if no job is runnable
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT id, m3u8_url FROM job WHERE status = ? AND next_run_at <= ? '
+                                    'ORDER BY next_run_at LIMIT 1', (self.QUEUED, now)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE job SET status = ?, updated_at = ? WHERE id = ?',
+                              (self.DOWNLOADING, now, row[0]))
+            self.conn.commit()
+        return row
+
+    def get_next_run_at(self):
+        with self.lock:
+            return self.conn.execute('SELECT MIN(next_run_at) FROM job WHERE status = ?', (self.QUEUED,)).fetchone()[0]
+
+    def set_submitted(self, job_id):
+        with self.lock:
+            self.conn.execute('UPDATE job SET status = ?, error = NULL, updated_at = ? WHERE id = ?',
+                              (self.SUBMITTED, time.time(), job_id))
+            self.conn.commit()
+
+    def set_failed(self, job_id, error, max_retries, backoff):
+        """
+        queue the job again after backoff * 2^(attempts - 1) seconds, or mark it failed after max_retries
+        :return: new status of the job
+        """
+
+        now = time.time()
+        with self.lock:
+            attempts = self.conn.execute('SELECT attempts FROM job WHERE id = ?', (job_id,)).fetchone()[0] + 1
+            status = self.FAILED if attempts > max_retries else self.QUEUED
+            next_run_at = now + backoff * 2 ** (attempts - 1)
+            self.conn.execute('UPDATE job SET status = ?, attempts = ?, next_run_at = ?, error = ?, updated_at = ? '
+                              'WHERE id = ?', (status, attempts, next_run_at, error, now, job_id))
+            self.conn.commit()
+        return status
+
+    def refresh_done(self):
+        """
+        mark submitted jobs as done if their result JSON has been fetched by fetch_transcription_results.py
+        """
+
+        with self.lock:
+            job_ids = [row[0] for row in self.conn.execute('SELECT id FROM job WHERE status = ?', (self.SUBMITTED,))]
+            done_ids = [job_id for job_id in job_ids if os.path.exists(f'./voice/{job_id}.json')]
+            self.conn.executemany('UPDATE job SET status = ?, updated_at = ? WHERE id = ?',
+                                  [(self.DONE, time.time(), job_id) for job_id in done_ids])
+            self.conn.commit()
+        return len(done_ids)
+
+    def get_jobs(self):
+        with self.lock:
+            return self.conn.execute('SELECT id, status, attempts, error, updated_at FROM job '
+                                     'ORDER BY updated_at').fetchall()
+
+    def close(self):
+        self.conn.close()
+        self.lock_file.close()
+
+
+def run_worker(job_queue, stats):
+    while True:
+        job = job_queue.pop()
+        if job is None:
+            next_run_at = job_queue.get_next_run_at()
+            if next_run_at is None:
+                return
+            time.sleep(max(next_run_at - time.time(), 0.1))
+            continue
+
+        job_id, m3u8_url = job
+        task = BashTask(f'bash transcribe_voice.sh {job_id} {m3u8_url}',
+                        TOOLS_ROOT, LOG_ROOT / 'voice' / f'{job_id}.log')
+        LOGGER.info(f'run: {task.cmd}')
+        LOGGER.info(f'logs will be saved in {task.log_fp}')
+        try:
+            result = task.run()
+        except Exception as e:
+            status = job_queue.set_failed(job_id, f'{type(e).__name__}: {e}', args.max_retries, args.backoff)
+            stats[status] += 1
+            LOGGER.exception(f'failed to run task for {job_id}, {status}')
+            continue
+        if result.returncode == 0:
+            job_queue.set_submitted(job_id)
+            stats['submitted'] += 1
+            LOGGER.info(f'submitted {job_id}')
+        else:
+            status = job_queue.set_failed(job_id, f'exit code {result.returncode}', args.max_retries, args.backoff)
+            stats[status] += 1
+            LOGGER.warning(f'failed to run task for {job_id} (exit code {result.returncode}), {status}')
+
+
+def show_status(job_queue):
+    job_queue.refresh_done()
+    jobs = job_queue.get_jobs()
+    status2count = defaultdict(int)
+    for job_id, status, attempts, error, updated_at in jobs:
+        status2count[status] += 1
+        if status != JobQueue.DONE:
+            LOGGER.info('{} {}: attempts={}, error={}, updated_at={}'.format(
+                job_id, status, attempts, error, datetime.fromtimestamp(updated_at).strftime('%Y-%m-%d %H:%M:%S')))
+    LOGGER.info('total {} jobs ({})'.format(
+        len(jobs), ', '.join(f'{status2count[status]} {status}' for status in JobQueue.STATUSES)))
+
+
 def main():
+    job_queue = JobQueue(args.queue)
+    if args.status:
+        show_status(job_queue)
+        job_queue.close()
+        return
+
+    if not job_queue.try_lock():
+        LOGGER.warning(f'another run is processing {args.queue}, exiting')
+        job_queue.close()
+        return
+    num_reset = job_queue.reset_interrupted()
+    if num_reset:
+        LOGGER.info(f'queued {num_reset} interrupted jobs again')
+
     minutes_finder = MinutesFinder(url='https://graphql.politylink.jp')
     minutes_list = minutes_finder.find(text='', dt=args.date)
     LOGGER.info(f'found {len(minutes_list)} minutes on {args.date.strftime("%Y-%m-%d")}')
 
-    tasks = []
+    num_jobs = 0
     for minutes in minutes_list:
         job_id = minutes.id.split(':')[-1]
-        job_files = glob.glob(f'./voice/{job_id}*')
-        if not args.overwrite and job_files:
-            LOGGER.info(f'{job_id} is already processed, skipping: {job_files}')
+        if not args.overwrite and job_id in job_queue:
+            LOGGER.info(f'{job_id} is already queued, skipping')
             continue
         try:
             video_url = get_video_url(minutes.urls)
             m3u8_url = get_m3u8_url(video_url)
-            task = BashTask(f'bash transcribe_voice.sh {job_id} {m3u8_url}',
-                            TOOLS_ROOT, LOG_ROOT / 'voice' / f'{job_id}.log')
-            tasks.append(task)
-            LOGGER.info(f'created task for {job_id}')
+            job_queue.add(job_id, m3u8_url)
+            num_jobs += 1
+            LOGGER.info(f'queued {job_id}')
         except Exception:
-            LOGGER.exception(f'failed to create task for {job_id}')
-    LOGGER.info(f'created total {len(tasks)} tasks')
+            LOGGER.exception(f'failed to create job for {job_id}')
+    LOGGER.info(f'queued total {num_jobs} jobs')
 
-    for task in tasks:
-        LOGGER.info(f'run: {task.cmd}')
-        LOGGER.info(f'logs will be saved in {task.log_fp}')
-        task.run(wait=False)
+    # jobs queued in previous runs (e.g. waiting for retry) are also processed
+    stats = defaultdict(int)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for future in [executor.submit(run_worker, job_queue, stats) for _ in range(args.workers)]:
+            future.result()
+    LOGGER.info('{} submitted, {} failed'.format(stats['submitted'], stats[JobQueue.FAILED]))
+    job_queue.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='GraphQLの審議中継のリンクからtranscribe_voice.shを呼び出す')
     parser.add_argument('-d', '--date', help='文字起こしする日付（yyyy-mm-dd）', type=date_type, default=datetime.now())
-    parser.add_argument('-o', '--overwrite', help='既に実行済ファイルがあっても実行する', action='store_true')
+    parser.add_argument('-o', '--overwrite', help='既にキューに追加済のジョブも再実行する', action='store_true')
+    parser.add_argument('-q', '--queue', help='ジョブの状態を保存するSQLiteファイル', default='./state/transcription_jobs.db')
+    parser.add_argument('-w', '--workers', help='同時に実行するジョブ数', type=int, default=2)
+    parser.add_argument('--max_retries', help='失敗したジョブを再実行する最大回数', type=int, default=3)
+    parser.add_argument('--backoff', help='失敗したジョブを再実行するまでの初期待ち時間（秒）', type=float, default=60)
+    parser.add_argument('-s', '--status', help='ジョブの状態を表示して終了する', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
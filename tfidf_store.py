@@ -0,0 +1,77 @@
+import logging
+from itertools import groupby
+import sqlite3
+import time
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TfidfStore:
+    """
+    SQLite store of term statistics (tf, tfidf) per minutes, used by minutes_wordcloud.py
+    terms are interned in the term table, so each (minutes, term) row only holds numbers
+    supports dict-like access so that statistics can be upserted and loaded per minutes
+    """
+
+    def __init__(self, db_fp):
+        Path(db_fp).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(db_fp)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS term (id INTEGER PRIMARY KEY, term TEXT UNIQUE NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS minutes (id TEXT PRIMARY KEY, updated_at REAL NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats (minutes_id TEXT NOT NULL, term_id INTEGER NOT NULL, '
+                          'tf INTEGER NOT NULL, tfidf REAL NOT NULL, PRIMARY KEY (minutes_id, term_id)) WITHOUT ROWID')
+        self.term2id = dict(self.conn.execute('SELECT term, id FROM term'))
+        self.updated_ids = set()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM minutes').fetchone()[0]
+
+    def __contains__(self, minutes_id):
+        return self.conn.execute('SELECT 1 FROM minutes WHERE id = ?', (minutes_id,)).fetchone() is not None
+
+    def __getitem__(self, minutes_id):
+        if minutes_id not in self:
+            raise KeyError(minutes_id)
+        rows = self.conn.execute('SELECT term.term, stats.tf, stats.tfidf FROM stats '
+                                 'JOIN term ON stats.term_id = term.id WHERE stats.minutes_id = ?', (minutes_id,))
+        return {term: (tf, tfidf) for term, tf, tfidf in rows}
+
+    def __setitem__(self, minutes_id, term2stats):
+        """
+        replace term statistics of the minutes
+        changes are not visible to other connections until commit()
+        """
+
+        rows = [(minutes_id, self.intern(term), stats[0], stats[1]) for term, stats in term2stats.items()]
+        self.conn.execute('DELETE FROM stats WHERE minutes_id = ?', (minutes_id,))
+        self.conn.executemany('INSERT INTO stats VALUES (?, ?, ?, ?)', rows)
+        self.conn.execute('INSERT OR REPLACE INTO minutes VALUES (?, ?)', (minutes_id, time.time()))
+        self.updated_ids.add(minutes_id)
+
+    def intern(self, term):
+        if term not in self.term2id:
+            cursor = self.conn.execute('INSERT INTO term (term) VALUES (?)', (term,))
+            self.term2id[term] = cursor.lastrowid
+        return self.term2id[term]
+
+    def update(self, all_data):
+        for minutes_id, term2stats in all_data.items():
+            self[minutes_id] = term2stats
+
+    def items(self):
+        """
+        yield (minutes id, term statistics) of all minutes, reading the stats table only once
+        """
+
+        rows = self.conn.execute('SELECT minutes.id, term.term, stats.tf, stats.tfidf FROM minutes '
+                                 'LEFT JOIN stats ON stats.minutes_id = minutes.id '
+                                 'LEFT JOIN term ON stats.term_id = term.id ORDER BY minutes.id')
+        for minutes_id, group in groupby(rows, key=lambda row: row[0]):
+            yield minutes_id, {term: (tf, tfidf) for _, term, tf, tfidf in group if term is not None}
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
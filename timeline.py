@@ -2,11 +2,13 @@ import argparse
 import logging
 from collections import defaultdict
 from datetime import timedelta, datetime
+from functools import partial
 
-from tqdm import tqdm
+from sgqlc.operation import Operation
 
-from politylink.graphql.client import GraphQLClient
-from politylink.graphql.schema import Timeline, _Neo4jDateTimeInput
+from politylink.graphql.client import GraphQLClient, Query
+from politylink.graphql.schema import Timeline, _Neo4jDateTimeInput, _TimelineFilter, _BillFilter, \
+    _MinutesFilter
 from politylink.idgen import idgen
 from utils import date_type
 
@@ -38,36 +40,113 @@ def build_date_dict(object_list, date_fields):
     return date2obj
 
 
+def to_neo4j_date(dt):
+    return _Neo4jDateTimeInput(year=dt.year, month=dt.month, day=dt.day)
+
+
+def fetch_all_bills(gql_client, start_date, end_date):
+    """
+    fetch Bills having at least one of BILL_DATE_FIELDS in [start_date, end_date)
+    """
+
+    filter_list = []
+    for field in BILL_DATE_FIELDS:
+        filter_ = _BillFilter(None)
+        setattr(filter_, f'{field}_gte', to_neo4j_date(start_date))
+        setattr(filter_, f'{field}_lt', to_neo4j_date(end_date))
+        filter_list.append(filter_)
+    filter_ = _BillFilter(None)
+    filter_.or_ = filter_list
+    return gql_client.get_all_bills(['id'] + BILL_DATE_FIELDS, filter_=filter_)
+
+
+def fetch_all_minutes(gql_client, start_date, end_date):
+    filter_ = _MinutesFilter(None)
+    filter_.start_date_time_gte = to_neo4j_date(start_date)
+    filter_.start_date_time_lt = to_neo4j_date(end_date)
+    return gql_client.get_all_minutes(['id'] + MINUTES_DATE_FIELD, filter_=filter_)
+
+
+def fetch_timeline2events(gql_client, start_date, end_date):
+    """
+    fetch existing links from events (Bill, Minutes, News) to Timeline in [start_date, end_date)
+    :return: dict of Timeline id to set of event ids
+    """
+
+    filter_ = _TimelineFilter(None)
+    filter_.date_gte = to_neo4j_date(start_date)
+    filter_.date_lt = to_neo4j_date(end_date)
+
+    op = Operation(Query)
+    timelines = op.timeline(filter=filter_)
+    timelines.id()
+    timelines.bills().id()
+    timelines.minutes().id()
+    timelines.news().id()
+
+    res = gql_client.endpoint(op)
+    gql_client.validate_response_or_raise(res)
+    timeline2events = dict()
+    for timeline in (op + res).timeline:
+        events = timeline.bills + timeline.minutes + timeline.news
+        timeline2events[timeline.id] = set(event.id for event in events)
+    return timeline2events
+
+
+def build_timeline(date):
+    timeline = Timeline(None)
+    timeline.date = to_neo4j_date(date)
+    timeline.id = idgen(timeline)
+    return timeline
+
+
 def main():
     gql_client = GraphQLClient()
-    bill_list = gql_client.get_all_bills(['id'] + BILL_DATE_FIELDS)
+    bill_list = fetch_all_bills(gql_client, args.start_date, args.end_date)
     LOGGER.info(f'fetched {len(bill_list)} bills')
-    minutes_list = gql_client.get_all_minutes(['id'] + MINUTES_DATE_FIELD)
+    minutes_list = fetch_all_minutes(gql_client, args.start_date, args.end_date)
     LOGGER.info(f'fetched {len(minutes_list)} minutes')
     news_list = gql_client.get_all_news(['id', 'is_timeline'] + NEWS_DATE_FIELD,
                                         start_date=args.start_date, end_date=args.end_date)
     LOGGER.info(f'fetched {len(news_list)} news')
+    timeline2events = fetch_timeline2events(gql_client, args.start_date, args.end_date)
+    LOGGER.info(f'fetched {len(timeline2events)} timelines')
     date2bill = build_date_dict(bill_list, BILL_DATE_FIELDS)
     date2minutes = build_date_dict(minutes_list, MINUTES_DATE_FIELD)
     date2news = build_date_dict(news_list, NEWS_DATE_FIELD)
 
+    new_timelines, link_pairs, unlink_pairs = [], [], []
     dates = [args.start_date + timedelta(i) for i in range((args.end_date - args.start_date).days)]
-    for date in tqdm(dates):
-        timeline = Timeline(None)
-        timeline.date = _Neo4jDateTimeInput(year=date.year, month=date.month, day=date.day)
-        timeline.id = idgen(timeline)
-        gql_client.merge(timeline)
+    for date in dates:
+        timeline = build_timeline(date)
+        if timeline.id not in timeline2events:
+            new_timelines.append(timeline)
 
-        from_ids = []
+        event_ids = set()
         for bill in date2bill[date]:
-            from_ids.append(bill.id)
+            event_ids.add(bill.id)
         for minutes in date2minutes[date]:
-            from_ids.append(minutes.id)
+            event_ids.add(minutes.id)
         for news in date2news[date]:
             if news.is_timeline:
-                from_ids.append(news.id)
-        gql_client.bulk_link(from_ids, [timeline.id] * len(from_ids))
-        LOGGER.info(f'linked {len(from_ids)} events to {date}')
+                event_ids.add(news.id)
+
+        existing_event_ids = timeline2events.get(timeline.id, set())
+        link_pairs += [(event_id, timeline.id) for event_id in sorted(event_ids - existing_event_ids)]
+        unlink_pairs += [(event_id, timeline.id) for event_id in sorted(existing_event_ids - event_ids)]
+        LOGGER.debug(f'found {len(event_ids)} events for {date}')
+
+    # mutations are executed in order, so Timelines are merged before being linked
+    op_builder_list = []
+    op_builder_list += [partial(gql_client.build_merge_operation, obj=timeline) for timeline in new_timelines]
+    op_builder_list += [partial(gql_client.build_link_operation, from_id=from_id, to_id=to_id)
+                        for from_id, to_id in link_pairs]
+    op_builder_list += [partial(gql_client.build_link_operation, from_id=from_id, to_id=to_id, remove=True)
+                        for from_id, to_id in unlink_pairs]
+    if op_builder_list:
+        gql_client.bulk_mutation(op_builder_list)
+    LOGGER.info(f'merged {len(new_timelines)} timelines, linked {len(link_pairs)} events '
+                f'and unlinked {len(unlink_pairs)} events for {len(dates)} dates')
 
 
 if __name__ == '__main__':
@@ -1,5 +1,123 @@
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
 from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger(__name__)
 
 
 def date_type(date_str):
     return datetime.strptime(date_str, '%Y-%m-%d').date()
+
+
+class RateLimiter:
+    """
+    thread-safe limiter to keep at least `interval` seconds between calls of wait()
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class HostRateLimiter:
+    """
+    thread-safe limiter to keep at least `interval` seconds between calls of wait() for each host
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.host2limiter = dict()
+
+    def get(self, url):
+        """
+        return RateLimiter of the host, which can be passed to HttpClient to limit retries as well
+        """
+
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host2limiter:
+                self.host2limiter[host] = RateLimiter(self.interval)
+            return self.host2limiter[host]
+
+    def wait(self, url):
+        self.get(url).wait()
+
+
+class HttpClient:
+    """
+    thread-safe HTTP client with connection pooling, timeout and retry
+    5xx responses, timeouts and connection errors are retried with jittered exponential backoff
+    if `limiter` (RateLimiter) is given to a request, every attempt including retries waits for it
+    number of requests, errors and total latency are recorded per `stats_key`, which defaults to the host
+    """
+
+    def __init__(self, timeout=30, max_retries=3, backoff=1.0, pool_size=10):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.stats = defaultdict(lambda: {'request': 0, 'error': 0, 'latency': 0.0})
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, limiter=None, stats_key=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        stats_key = stats_key if stats_key else urlparse(url).netloc
+        for i in range(self.max_retries + 1):
+            if limiter:
+                limiter.wait()
+            start_time = time.monotonic()
+            response, error = None, None
+            try:
+                response = self.session.request(method, url, **kwargs)
+                if response.status_code >= 500:
+                    error = f'status={response.status_code}'
+            except (requests.Timeout, requests.ConnectionError) as e:
+                if i == self.max_retries:
+                    self._record(stats_key, time.monotonic() - start_time, is_error=True)
+                    raise
+                error = type(e).__name__  # repr may contain the query string
+            self._record(stats_key, time.monotonic() - start_time, is_error=error is not None)
+            if error is None or i == self.max_retries:
+                return response
+            sleep_sec = self.backoff * (2 ** i) * random.uniform(0.5, 1.5)
+            LOGGER.warning(f'retry {method} {url.split("?")[0]} in {sleep_sec:.1f}s: {error}')
+            time.sleep(sleep_sec)
+
+    def _record(self, stats_key, latency, is_error):
+        with self.lock:
+            stats = self.stats[stats_key]
+            stats['request'] += 1
+            stats['error'] += int(is_error)
+            stats['latency'] += latency
+
+    def log_stats(self, logger=LOGGER):
+        for stats_key, stats in sorted(self.stats.items()):
+            logger.info('{}: {} requests, {} errors, {:.2f}s average latency'.format(
+                stats_key, stats['request'], stats['error'], stats['latency'] / stats['request']
+            ))